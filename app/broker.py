@@ -0,0 +1,467 @@
+import os
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+from app.jobs import Job, JobLost, create_job_dir, job_id, output_filename, owner_digest, request_key, resumable_dir, reap_stale_jobs, run_job
+
+from learninghub.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+BROKERS = ("sqlite",)
+
+
+class SqliteBroker():
+    """Exchanges jobs, their log and progress packets and their results
+    between the web servers and the conversion workers through a sqlite
+    database.
+
+    All processes on a host may share the database. Processes on several
+    hosts may share it only on a filesystem with working POSIX locks, which
+    rules out most network filesystems. The jobs' temporary directories,
+    which hold their output, must be shared in the same way.
+
+    A job's credentials are stored until the job finished, such that another
+    worker can take over the job of a worker which was lost. The database is
+    therefore only readable by its owner.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        with self._transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, owner TEXT NOT NULL, state TEXT NOT NULL, "
+                       "creds TEXT, tmpdir TEXT NOT NULL, output_filename TEXT NOT NULL, error TEXT, worker TEXT, "
+                       "subscribers INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, updated REAL NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, packet TEXT NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS events_by_job ON events (job_id, seq)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, created)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)  # autocommit, for reads
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("BEGIN IMMEDIATE")  # serializes writers, such that e.g. two workers never claim the same job
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def submit(self, job_id, owner, creds, tmpdir, output_filename):
+        """Enqueues a job, unless a queued or running job has the same owner
+        digest (see 'app.jobs.owner_digest'). Resubmitting the id of a
+        finished job enqueues it again.
+
+        Returns:
+            str: the id of the job which serves the request
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT id FROM jobs WHERE owner = ? AND state IN ('queued', 'running')", (owner,)).fetchone()
+            if row is not None:
+                return row["id"]
+            db.execute("DELETE FROM events WHERE job_id = ?", (job_id,))
+            db.execute("INSERT OR REPLACE INTO jobs (id, owner, state, creds, tmpdir, output_filename, created, updated) "
+                       "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                       (job_id, owner, json.dumps(creds), tmpdir, output_filename, now, now))
+        return job_id
+
+    def claim(self, worker):
+        """Marks the oldest queued job as run by 'worker'.
+
+        Returns:
+            dict: the job's columns, its credentials decoded, or 'None' if no
+                job is queued
+        """
+        with self._transaction() as db:
+            row = db.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'running', worker = ?, updated = ? WHERE id = ?", (worker, time.time(), row["id"]))
+        job = dict(row)
+        job["creds"] = json.loads(job["creds"])
+        return job
+
+    def heartbeat(self, worker, job_ids):
+        """Signals that 'worker' is alive and runs the given jobs.
+
+        Returns:
+            set: the ids of the given jobs which 'worker' still runs. The
+                others were taken over by another worker (see 'requeue_lost').
+        """
+        now = time.time()
+        with self._transaction() as db:
+            return {i for i in job_ids
+                    if db.execute("UPDATE jobs SET updated = ? WHERE id = ? AND state = 'running' AND worker = ?", (now, i, worker)).rowcount}
+
+    def requeue_lost(self, timeout):
+        """Enqueues the running jobs again whose worker did not signal for
+        'timeout' seconds. They are queued by their original creation time,
+        i.e. ahead of newer jobs. A silent worker which is still alive
+        learns from its next heartbeat that it lost the jobs.
+
+        Returns:
+            int: number of requeued jobs
+        """
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'queued', worker = NULL WHERE state = 'running' AND updated < ?",
+                              (time.time() - timeout,)).rowcount
+
+    def publish(self, job_id, packet):
+        """Appends a packet (a JSON string, see 'app.util') to a job's events."""
+        with self._transaction() as db:
+            db.execute("INSERT INTO events (job_id, packet) VALUES (?, ?)", (job_id, packet))
+
+    def events(self, job_id, after=0):
+        """Returns the pairs of sequence number and packet a job published
+        after the sequence number 'after'."""
+        with self._connect() as db:
+            return [tuple(row) for row in db.execute("SELECT seq, packet FROM events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after))]
+
+    def finish(self, job_id, error=None, worker=None):
+        """Marks a job as done, or as failed if 'error' is given, and drops
+        its credentials. If 'worker' is given, the job is only marked if that
+        worker still runs it.
+
+        Returns:
+            bool: whether the job was marked
+        """
+        query = "UPDATE jobs SET state = ?, error = ?, creds = NULL, updated = ? WHERE id = ?"
+        args = ("done" if error is None else "failed", error, time.time(), job_id)
+        if worker is not None:
+            query += " AND state = 'running' AND worker = ?"
+            args += (worker,)
+        with self._transaction() as db:
+            return db.execute(query, args).rowcount > 0
+
+    def job(self, job_id):
+        """Returns a job's columns except its credentials, or 'None' if the
+        job is unknown."""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        del job["creds"]
+        return job
+
+    def subscribe(self, job_id, delta):
+        """Changes the number of clients waiting for a job on any server.
+
+        Returns:
+            int: the new number of subscribers
+        """
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET subscribers = subscribers + ? WHERE id = ?", (delta, job_id))
+            row = db.execute("SELECT subscribers FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def position(self, job_id):
+        """Returns a job's 1-based position in the queue, or 0 if the job is
+        not waiting (anymore)."""
+        with self._connect() as db:
+            row = db.execute("SELECT state, created FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row["state"] != "queued":
+                return 0
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND created <= ?", (row["created"],)).fetchone()[0]
+
+    def active_ids(self):
+        """Returns the ids of all queued and running jobs."""
+        with self._connect() as db:
+            return {row[0] for row in db.execute("SELECT id FROM jobs WHERE state IN ('queued', 'running')")}
+
+    def prune(self, max_age):
+        """Removes the finished jobs and their events which have not been
+        updated for 'max_age' seconds."""
+        with self._transaction() as db:
+            stale = [row[0] for row in db.execute("SELECT id FROM jobs WHERE state IN ('done', 'failed') AND updated < ?", (time.time() - max_age,))]
+            db.executemany("DELETE FROM events WHERE job_id = ?", [(i,) for i in stale])
+            db.executemany("DELETE FROM jobs WHERE id = ?", [(i,) for i in stale])
+
+
+def make_broker(url):
+    """Returns a broker by url, e.g. 'sqlite:////srv/learninghub2pdf/broker.db'
+    for a sqlite database at an absolute path.
+
+    Raises:
+        ValueError: if the url's scheme is not one of 'BROKERS'
+    """
+    scheme, _, path = url.partition("://")
+    if scheme not in BROKERS or not path:
+        raise ValueError(f"Invalid broker '{url}', expected e.g. 'sqlite:///path/to/broker.db'.")
+    return SqliteBroker(path[1:] if path.startswith("/") else path)
+
+
+class BrokerChannel():
+    """Stand-in for a websocket which publishes what a worker's job logger
+    sends to the broker, from where the web servers forward it to their
+    clients."""
+    def __init__(self, broker, job_id, retries=5, backoff=0.5):
+        self.broker = broker
+        self.job_id = job_id
+        self.retries = retries
+        self.backoff = backoff
+
+    def send(self, packet):
+        """Publishes a packet. Database errors, e.g. a database locked for
+        longer than the connection's timeout, are retried with exponential
+        backoff, after which the packet is dropped.
+
+        Raises:
+            ConnectionError: if the job is gone, which detaches the channel
+                from the job's logger
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self.broker.publish(self.job_id, packet)
+                return
+            except sqlite3.Error as e:
+                error = e
+            try:
+                if self.broker.job(self.job_id) is None:
+                    raise ConnectionError(f"Job '{self.job_id}' is gone.")
+            except sqlite3.Error:
+                pass
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2**attempt)
+        logger.warning(f"Dropped a packet of job '{self.job_id}' after {self.retries + 1} attempts: {error}")
+
+
+class RemoteJob():
+    """A job run by a worker, as seen by a web server: forwards the job's
+    events to the server's subscribed clients until the job finished.
+
+    Provides the attributes of 'app.jobs.Job' which the web server uses.
+    """
+    def __init__(self, broker, job, cleanup=True, poll_interval=0.25):
+        self.broker = broker
+        self.id = job["id"]
+        self.tmpdir = job["tmpdir"]
+        self.output_filename = job["output_filename"]
+        self.output_path = f"{self.tmpdir}/{self.output_filename}"
+        self.cleanup = cleanup
+        self.poll_interval = poll_interval
+        self.done = threading.Event()
+        self.error = None
+        self._socks = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self._follow, daemon=True).start()
+
+    def subscribe(self, sock):
+        with self._lock:
+            self._socks.append(sock)
+        self.broker.subscribe(self.id, 1)
+
+    def release(self, sock):
+        with self._lock:
+            if sock in self._socks:
+                self._socks.remove(sock)
+        remaining = self.broker.subscribe(self.id, -1)
+        if remaining <= 0 and self.done.is_set() and self.error is None and self.cleanup:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _send(self, packet):
+        with self._lock:
+            socks = list(self._socks)
+        for sock in socks:
+            try:
+                sock.send(packet)
+            except Exception:
+                with self._lock:
+                    if sock in self._socks:
+                        self._socks.remove(sock)
+
+    def _follow(self):
+        after = 0
+        while True:
+            try:
+                # The state is read before the events, such that the events
+                # published before the job finished are all forwarded.
+                job = self.broker.job(self.id)
+                for after, packet in self.broker.events(self.id, after):
+                    self._send(packet)
+            except sqlite3.Error as e:
+                logger.warning(f"Error polling job '{self.id}': {e}")
+                time.sleep(self.poll_interval)
+                continue
+            if job is None:
+                self.error = "The job was removed from the broker."
+            elif job["state"] in ("done", "failed"):
+                self.error = job["error"]
+            else:
+                time.sleep(self.poll_interval)
+                continue
+            self.done.set()
+            return
+
+
+class BrokerScheduler():
+    """Enqueues conversions with a broker, from which workers (see 'Worker')
+    take them, possibly on other hosts. Offers the interface of
+    'app.jobs.Scheduler' to the web server.
+
+    Identical requests are coalesced across all servers sharing the broker.
+    Directories of jobs untouched for 'stale_after' seconds and their records
+    in the broker are removed periodically.
+    """
+    def __init__(self, broker, tmpdir_root="/tmp", cleanup=True, stale_after=24*3600, poll_interval=0.25):
+        self.broker = broker
+        self.tmpdir_root = tmpdir_root
+        self.cleanup = cleanup
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self._jobs = {}  # job id -> RemoteJob followed by this server
+        self._lock = threading.Lock()
+        threading.Thread(target=self._reap, daemon=True).start()
+
+    def submit(self, creds, sock):
+        """Returns the job converting the requested ebook, enqueuing it unless
+        an identical request is in flight. The socket is subscribed to the
+        job. Earlier jobs are resumed as by 'app.jobs.Scheduler.submit'."""
+        key = request_key(creds)
+        tmpdir = resumable_dir(self.tmpdir_root, creds.get("resume"), key)
+        created = tmpdir is None
+        if created:
+            tmpdir = create_job_dir(self.tmpdir_root, key)
+        submitted_id = self.broker.submit(job_id(tmpdir), owner_digest(key), creds, tmpdir, output_filename(creds))
+        if submitted_id != job_id(tmpdir):
+            logger.debug(f"Coalesce request with job '{submitted_id}'.")
+            if created:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        with self._lock:
+            job = self._jobs.get(submitted_id)
+            if job is None or job.done.is_set():
+                job = RemoteJob(self.broker, self.broker.job(submitted_id), cleanup=self.cleanup, poll_interval=self.poll_interval)
+                self._jobs[submitted_id] = job
+            job.subscribe(sock)
+        return job
+
+    def position(self, job):
+        return self.broker.position(job.id)
+
+    def _reap(self):
+        while True:
+            try:
+                with self._lock:
+                    for finished in [i for i, job in self._jobs.items() if job.done.is_set()]:
+                        del self._jobs[finished]
+                reap_stale_jobs(self.tmpdir_root, self.stale_after, self.broker.active_ids())
+                self.broker.prune(self.stale_after)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Error removing stale jobs: {e}")
+            time.sleep(min(self.stale_after, 600))
+
+
+class Worker():
+    """Runs the conversions enqueued with a broker on a bounded pool of
+    threads. Any number of workers may share a broker.
+
+    A worker signals every 'lost_after / 4' seconds that it is alive. Jobs of
+    workers which were silent for 'lost_after' seconds are taken over by
+    another worker, which resumes them in their directory if the conversion
+    checkpoints its progress (see 'resumable_jobs'). If the silent worker is
+    still alive, it stops those jobs once it notices (see 'app.jobs.JobLost'),
+    such that no two workers write to a job's directory for long.
+    """
+    def __init__(self, broker, run, workers=2, tmpdir_root="/tmp", lost_after=60, poll_interval=1):
+        """
+        Args:
+            broker (SqliteBroker): broker to take the jobs from
+            run (callable): Job -> None; see 'app.jobs.Scheduler'
+            workers (int): maximum number of concurrent conversions
+            tmpdir_root (str): directory below which the web servers create
+                the jobs' temporary directories
+            lost_after (float): seconds after which the jobs of a silent
+                worker are run again
+            poll_interval (float): seconds between polls of an empty queue
+        """
+        self.broker = broker
+        self.run = run
+        self.tmpdir_root = tmpdir_root
+        self.lost_after = lost_after
+        self.poll_interval = poll_interval
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self._running = {}  # id -> Job run by this worker
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, workers))]
+        self._threads.append(threading.Thread(target=self._heartbeat, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        """Blocks while the worker runs, i.e. until the process is stopped."""
+        for thread in self._threads:
+            thread.join()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lost_after / 4)
+            with self._lock:
+                running = dict(self._running)
+            try:
+                owned = self.broker.heartbeat(self.name, list(running))
+                self.broker.requeue_lost(self.lost_after)
+            except sqlite3.Error as e:
+                logger.warning(f"Error signaling the broker: {e}")
+                continue
+            for lost_id in set(running) - owned:
+                logger.warning(f"Job '{lost_id}' was taken over by another worker. Stop it.")
+                running[lost_id].logger.abort(JobLost(f"Job '{lost_id}' was taken over by another worker."))
+
+    def _claim(self):
+        try:
+            return self.broker.claim(self.name)
+        except sqlite3.Error as e:
+            logger.warning(f"Error claiming a job: {e}")
+            return None
+
+    def _finish(self, job_id, error):
+        try:
+            if not self.broker.finish(job_id, error, worker=self.name):
+                logger.warning(f"Job '{job_id}' was taken over by another worker before it finished.")
+        except sqlite3.Error as e:  # the job is run again once it is considered lost
+            logger.warning(f"Error finishing job '{job_id}': {e}")
+
+    def _work(self):
+        while True:
+            claimed = self._claim()
+            if claimed is None:
+                time.sleep(self.poll_interval)
+                continue
+            REGISTRY.observe("learninghub_stage_seconds", max(0, time.time() - claimed["created"]), stage="queue")
+            try:
+                job = Job(request_key(claimed["creds"]), claimed["creds"], self.tmpdir_root, resume_dir=claimed["tmpdir"])
+            except OSError as e:  # e.g. the directory is not shared with this worker
+                logger.warning(f"Error opening the directory of job '{claimed['id']}': {e}")
+                self._finish(claimed["id"], f"The worker cannot access the job's directory: {e}")
+                continue
+            with self._lock:
+                self._running[job.id] = job
+            job.logger.add_socket(BrokerChannel(self.broker, job.id))
+            logger.debug(f"Run job '{job.id}'.")
+            error = run_job(self.run, job)
+            job.finish(error)  # publishes the remaining lines before the job is marked as finished
+            with self._lock:
+                self._running.pop(job.id, None)
+            self._finish(job.id, error)
@@ -0,0 +1,256 @@
+import os
+import re
+import glob
+import hmac
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import time
+import threading
+import traceback
+from collections import deque
+from datetime import datetime
+
+from app import util
+
+from learninghub.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class JobLost(Exception):
+    """Raised into a conversion whose job was taken over by another worker
+    (see 'app.broker.Worker')."""
+
+
+class Job():
+    """A single conversion and the clients waiting for its result.
+
+    Each job owns a temporary directory holding the job's logfile and output.
+    The directory is removed once the job has finished and all subscribed
+    clients released it. The directory of a failed or abandoned job is kept,
+    such that the job can be resumed by its id (see 'Scheduler.submit').
+    """
+    def __init__(self, key, creds, tmpdir_root, cleanup=True, resume_dir=None):
+        self.key = key
+        self.creds = creds
+        self.tmpdir = resume_dir if resume_dir is not None else create_job_dir(tmpdir_root, key)
+        self.id = job_id(self.tmpdir)
+        self.output_filename = output_filename(creds)
+        self.output_path = f"{self.tmpdir}/{self.output_filename}"
+        self.logfile = open(f"{self.tmpdir}/log", "a")
+        self.logger = util.SocketLogger(None, self.logfile)
+        self.done = threading.Event()
+        self.error = None  # traceback of an uncaught exception
+        self.cleanup = cleanup
+        self.created = time.monotonic()
+        self._subscribers = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, sock):
+        """Registers a client which receives the job's log and result. Must be
+        followed by a call to 'release' once the client is served."""
+        with self._lock:
+            self._subscribers += 1
+        self.logger.add_socket(sock)
+
+    def release(self, sock):
+        self.logger.remove_socket(sock)
+        with self._lock:
+            self._subscribers -= 1
+            remove = self._subscribers == 0 and self.done.is_set() and self.error is None and self.cleanup
+        if remove:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def finish(self, error=None):
+        # Without subscribers the directory is kept, such that a client which
+        # lost its connection can still fetch the result by resuming the job.
+        # Otherwise it is left to 'reap_stale_jobs'.
+        self.error = error
+        self.logger.close()  # sends the remaining lines before the result
+        self.logfile.close()
+        with self._lock:
+            self.done.set()
+
+
+def create_job_dir(tmpdir_root, key):
+    """Creates the temporary directory of a new job, which records the job's
+    id and a digest of the request key.
+
+    Returns:
+        str: the directory's path, see 'job_id'
+    """
+    new_id = uuid.uuid4().hex
+    # Free of ':' and ';', which separate the arguments of 'inkscape --shell'.
+    tmpdir = f"{tmpdir_root}/learninghub2pdf-{datetime.now().strftime('%Y-%m-%dT%H%M%S')}-{new_id}"
+    os.mkdir(tmpdir)
+    with open(f"{tmpdir}/job.json", "w") as f:
+        json.dump({"id": new_id, "owner": owner_digest(key)}, f)
+    return tmpdir
+
+
+def job_id(tmpdir):
+    """Returns the id of the job owning a temporary directory."""
+    return tmpdir.rsplit("-", 1)[1]
+
+
+def output_filename(creds):
+    """Returns the filename of the PDF converted for a request."""
+    filename = creds["indexhtml"].split("/")[-2]  # path segment prior to /index.html
+    if creds.get("page_range"):
+        first_page, last_page = creds["page_range"]
+        filename += f"-p{first_page}-{last_page or 'end'}"
+    return filename + ".pdf"
+
+
+def request_key(creds):
+    """Returns the key under which identical requests are coalesced.
+
+    Requests are only identical if they ask for the same pages of the same
+    ebook with the same credentials, such that every user's access is
+    verified by their own login. The password enters the key only as a keyed
+    hash.
+    """
+    password_hash = hmac.new(creds["username"].encode(), creds["password"].encode(), hashlib.sha256).hexdigest()
+    page_range = creds.get("page_range")
+    return (creds["indexhtml"], tuple(page_range) if page_range else None, creds["username"], password_hash)
+
+
+def owner_digest(key):
+    """Returns a digest of a request key, stored with a job to verify that
+    whoever resumes the job sent an identical request."""
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def resumable_dir(tmpdir_root, resume_id, key):
+    """Returns the directory of the job to resume, if the job exists and was
+    started by an identical request."""
+    if not isinstance(resume_id, str) or not re.fullmatch("[0-9a-f]{32}", resume_id):
+        return None
+    for tmpdir in glob.glob(f"{tmpdir_root}/learninghub2pdf-*-{resume_id}"):
+        try:
+            with open(f"{tmpdir}/job.json") as f:
+                if json.load(f)["owner"] == owner_digest(key):
+                    return tmpdir
+        except (OSError, ValueError, KeyError):
+            pass
+    return None
+
+
+def run_job(run, job):
+    """Performs a job's conversion.
+
+    Returns:
+        str: traceback of an uncaught exception, or 'None'
+    """
+    try:
+        run(job)
+    except JobLost as e:  # the job's logger raises it, too
+        return str(e)
+    except Exception:
+        # Uncaught exceptions indicate a critical error (most likely the website layout changed).
+        error = traceback.format_exc()
+        job.logger.critical(f"Uncaught exception: {error}")
+        return error
+    return None
+
+
+def reap_stale_jobs(tmpdir_root, max_age, active_ids=()):
+    """Removes the temporary directories of jobs which have not been touched
+    for 'max_age' seconds, except those of the given active jobs."""
+    for tmpdir in glob.glob(f"{tmpdir_root}/learninghub2pdf-*-*"):
+        if job_id(tmpdir) in active_ids or not os.path.isfile(f"{tmpdir}/job.json"):
+            continue
+        paths = [tmpdir] + [f"{tmpdir}/{name}" for name in ("log", "manifest.json")]
+        last_touched = max(os.path.getmtime(path) for path in paths if os.path.exists(path))
+        if time.time() - last_touched > max_age:
+            logger.info(f"Remove stale job directory '{tmpdir}'.")
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class Scheduler():
+    """Runs conversions on a bounded pool of worker threads.
+
+    Jobs are started in FIFO order. A request identical to a queued or
+    running job subscribes to that job instead of starting a new one.
+    Directories of jobs untouched for 'stale_after' seconds are removed
+    periodically.
+    """
+    def __init__(self, run, workers=2, tmpdir_root="/tmp", cleanup=True, stale_after=24*3600):
+        """
+        Args:
+            run (callable): Job -> None; performs the conversion, writing to
+                'job.output_path' and logging to 'job.logger'
+            workers (int): maximum number of concurrent conversions
+            tmpdir_root (str): directory below which the jobs' temporary
+                directories are created
+            cleanup (bool): remove the temporary directories of successful jobs
+            stale_after (float): seconds after which the directories of
+                abandoned jobs are removed
+        """
+        self.run = run
+        self.tmpdir_root = tmpdir_root
+        self.cleanup = cleanup
+        self.stale_after = stale_after
+        self._queue = deque()
+        self._active = {}  # request key -> queued or running job
+        self._cond = threading.Condition()
+        for _ in range(max(1, workers)):
+            threading.Thread(target=self._work, daemon=True).start()
+        threading.Thread(target=self._reap, daemon=True).start()
+
+    def submit(self, creds, sock):
+        """Returns the job converting the requested ebook, creating and
+        enqueuing it unless an identical request is in flight. The socket is
+        subscribed to the job.
+
+        If 'creds' contains the id of an earlier job under "resume", and that
+        job's directory still exists, the new job continues in it."""
+        key = request_key(creds)
+        with self._cond:
+            job = self._active.get(key)
+            if job is None:
+                resume_dir = resumable_dir(self.tmpdir_root, creds.get("resume"), key)
+                job = Job(key, creds, self.tmpdir_root, cleanup=self.cleanup, resume_dir=resume_dir)
+                if resume_dir is not None:
+                    logger.debug(f"Resume job '{job.id}'.")
+                self._active[key] = job
+                self._queue.append(job)
+                self._cond.notify()
+            else:
+                logger.debug(f"Coalesce request with job '{job.id}'.")
+            job.subscribe(sock)
+        return job
+
+    def position(self, job):
+        """Returns the job's 1-based position in the queue, or 0 if the job
+        is not waiting (anymore)."""
+        with self._cond:
+            try:
+                return self._queue.index(job) + 1
+            except ValueError:
+                return 0
+
+    def _reap(self):
+        while True:
+            with self._cond:
+                active_ids = {job.id for job in self._active.values()}
+            try:
+                reap_stale_jobs(self.tmpdir_root, self.stale_after, active_ids)
+            except OSError as e:
+                logger.warning(f"Error removing stale job directories: {e}")
+            time.sleep(min(self.stale_after, 600))
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                job = self._queue.popleft()
+            REGISTRY.observe("learninghub_stage_seconds", time.monotonic() - job.created, stage="queue")
+            error = run_job(self.run, job)
+            with self._cond:
+                del self._active[job.key]
+            job.finish(error)
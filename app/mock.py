@@ -1,11 +1,10 @@
 import time
-import PyPDF2
 import logging
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
-def ebook2pdf_userpass_learninghub_noop(indexhtml, username, password, output_filename="ebook.pdf", output_dir=None, temp_dir=None, max_pages=1e6, logger=logger):
+def ebook2pdf_userpass_learninghub_noop(indexhtml, username, password, output_filename="ebook.pdf", output_dir=None, temp_dir=None, max_pages=1e6, download_concurrency=1, render_workers=None, render_batch_size=None, max_pages_in_flight=32, cache=None, session_cache=None, browser_pool=None, font_store=None, metrics=None, checkpoint=False, fetch_retries=5, optimize_svgs=False, renderer="inkscape", first_page=1, last_page=None, incremental=False, logger=logger):
     """Mimicks the communication between the flask server and the client
     without sending any requests to the learninghub. A dummy output file is
     generated at the end which can be sent to the client.
@@ -30,13 +29,14 @@ def ebook2pdf_userpass_learninghub_noop(indexhtml, username, password, output_fi
     logger.info("Download webFonts.css.")
     logger.info("Download the ebook's required fonts.")
     logger.info("Generate TTF fonts from downloaded WOFF2 fonts.")
-    logger.info("Copy TTF fonts to fontconfig directory 'foo/bar'.")
-    logger.info("Regenerate fontconfig cache.")
+    logger.info("Write fontconfig configuration 'foo/bar/fonts.conf'.")
+    logger.info("Generate fontconfig cache.")
     logger.info("Generate individual PDFs from the downloaded SVGs using inkscape.")
     logger.info("Concatenate PDFs into a single document.")
     time.sleep(1)
 
     # Generate a synthetic output file.
+    import PyPDF2
     pdf = PyPDF2.PdfFileWriter()
     pdf.addBlankPage(219, 297)
     output_path = f"{output_dir}/{output_filename}"
@@ -1,15 +1,74 @@
-import shutil
 import json
-import tempfile
-import shutil
-import traceback
-from datetime import datetime
+import time
+import threading
 
-from flask import render_template
+from flask import render_template, send_file, url_for, abort, Response
 
 from app import app, sock, logger, util, mock
+from app.jobs import Scheduler
+from app.broker import BrokerScheduler, Worker, make_broker
 
-from learninghub import ebook2pdf_userpass
+from learninghub.cache import Cache
+from learninghub.sessions import SessionCache
+from learninghub.browsers import LOGIN_TIMEOUT_SECONDS, BrowserPool
+from learninghub.fonts import FontStore
+from learninghub.metrics import REGISTRY
+
+
+_cache = None
+_session_cache = None
+_browser_pool = None
+_scheduler = None
+_broker = None
+_font_store = None
+_download_tokens = None
+_init_lock = threading.Lock()  # guards the lazy initialization below
+
+
+def get_cache():
+    """Returns the cache shared by all conversions, or 'None' if caching is
+    disabled by leaving 'cache_dir' empty."""
+    global _cache
+    with _init_lock:
+        if _cache is None and app.config.get("cache_dir"):
+            _cache = Cache(app.config["cache_dir"], app.config.get("cache_quota_mb", 4096) * 2**20)
+    return _cache
+
+
+def get_session_cache():
+    """Returns the cache of the users' cookies, or 'None' if disabled by
+    setting 'session_ttl_minutes' to 0."""
+    global _session_cache
+    with _init_lock:
+        if _session_cache is None and app.config.get("session_ttl_minutes", 60):
+            _session_cache = SessionCache(app.config.get("session_ttl_minutes", 60) * 60)
+    return _session_cache
+
+
+def get_browser_pool():
+    """Returns the pool of warm browsers used for logins, or 'None' if
+    disabled by setting 'browser_pool_size' to 0."""
+    global _browser_pool
+    with _init_lock:
+        if _browser_pool is None and app.config.get("browser_pool_size", 2):
+            max_rss_mb = app.config.get("browser_max_rss_mb")
+            _browser_pool = BrowserPool(
+                size=app.config.get("browser_pool_size", 2),
+                max_uses=app.config.get("browser_max_uses", 20),
+                max_rss_bytes=max_rss_mb * 2**20 if max_rss_mb else None,
+                checkout_timeout=app.config.get("browser_checkout_timeout") or LOGIN_TIMEOUT_SECONDS)
+            _browser_pool.warm()
+    return _browser_pool
+
+
+def get_font_store():
+    """Returns the store of decompressed fonts, or 'None' if disabled by
+    leaving 'font_store_dir' empty."""
+    global _font_store
+    with _init_lock:
+        if _font_store is None and app.config.get("font_store_dir"):
+            _font_store = FontStore(app.config["font_store_dir"], app.config.get("font_store_quota_mb", 256) * 2**20)
+    return _font_store
 
 
 @app.route("/")
@@ -24,42 +83,173 @@ def index():
     return render_template("index.html", **template_params)
 
 
+@app.route("/metrics")
+def metrics():
+    """Exposes the conversions' aggregated metrics to Prometheus."""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+def run_conversion(job):
+    """Performs a job's conversion. Run by the scheduler's workers."""
+    args = {
+        "indexhtml": job.creds["indexhtml"],
+        "username": job.creds["username"],
+        "password": job.creds["password"],
+        "output_filename": job.output_filename,
+        "output_dir": job.tmpdir,
+        "temp_dir": job.tmpdir,
+        "max_pages": app.config.get("debug_max_pages", 1e6),
+        "download_concurrency": app.config.get("download_concurrency", 1),
+        "render_workers": app.config.get("render_workers"),
+        "render_batch_size": app.config.get("render_batch_size"),
+        "max_pages_in_flight": app.config.get("max_pages_in_flight", 32),
+        "cache": get_cache(),
+        "session_cache": get_session_cache(),
+        "browser_pool": get_browser_pool(),
+        "font_store": get_font_store(),
+        "checkpoint": app.config.get("resumable_jobs", True),
+        "fetch_retries": app.config.get("fetch_retries", 5),
+        "optimize_svgs": app.config.get("optimize_svgs", False),
+        "renderer": app.config.get("renderer", "inkscape"),
+        "first_page": (job.creds.get("page_range") or (1, None))[0],
+        "last_page": (job.creds.get("page_range") or (1, None))[1],
+        "incremental": app.config.get("incremental_updates", False),
+        "logger": job.logger
+    }
+    if app.config.get("debug_learninghub_noop"):
+        mock.ebook2pdf_userpass_learninghub_noop(**args)
+    else:
+        from learninghub import ebook2pdf_userpass  # loads the conversion's dependencies on first use
+        ebook2pdf_userpass(**args)
+
+
+def get_broker():
+    """Returns the broker through which the server hands its jobs to the
+    workers, or 'None' if the server runs the conversions itself because
+    'broker' is left empty."""
+    global _broker
+    with _init_lock:
+        if _broker is None and app.config.get("broker"):
+            _broker = make_broker(app.config["broker"])
+    return _broker
+
+
+def get_scheduler():
+    """Returns the scheduler which runs at most 'max_concurrent_jobs'
+    conversions at a time, or which enqueues them with the broker."""
+    global _scheduler
+    broker = get_broker()
+    with _init_lock:
+        if _scheduler is None and broker is not None:
+            _scheduler = BrokerScheduler(broker,
+                                         tmpdir_root=app.config.get("tmpdir", "/tmp"),
+                                         cleanup=not app.config.get("debug_no_cleanup"),
+                                         stale_after=app.config.get("stale_job_hours", 24) * 3600)
+        elif _scheduler is None:
+            _scheduler = Scheduler(run_conversion,
+                                   workers=app.config.get("max_concurrent_jobs", 2),
+                                   tmpdir_root=app.config.get("tmpdir", "/tmp"),
+                                   cleanup=not app.config.get("debug_no_cleanup"),
+                                   stale_after=app.config.get("stale_job_hours", 24) * 3600)
+    return _scheduler
+
+
+def run_worker():
+    """Runs at most 'max_concurrent_jobs' of the conversions enqueued with
+    the broker at a time, until the process is stopped."""
+    broker = get_broker()
+    if broker is None:
+        raise ValueError("Worker mode requires a 'broker' in the configuration.")
+    worker = Worker(broker, run_conversion,
+                    workers=app.config.get("max_concurrent_jobs", 2),
+                    tmpdir_root=app.config.get("tmpdir", "/tmp"),
+                    lost_after=app.config.get("worker_lost_seconds", 60))
+    worker.join()
+
+
+def get_download_tokens():
+    """Returns the registry of download links, which expire after
+    'download_ttl_minutes'."""
+    global _download_tokens
+    with _init_lock:
+        if _download_tokens is None:
+            _download_tokens = util.DownloadTokens(app.config.get("download_ttl_minutes", 10) * 60)
+    return _download_tokens
+
+
+def warm_up(worker=False):
+    """Imports the conversion's dependencies and initializes the shared
+    engines, such that the first conversion does not wait for them. Run in a
+    background thread after startup if 'warm_up' is enabled; otherwise, all
+    of this happens on first use. A server which hands its jobs to workers
+    only initializes its scheduler.
+
+    Args:
+        worker (bool): whether the process runs as a worker
+
+    Returns:
+        dict: seconds spent on each step
+    """
+    seconds = {}
+    steps = [] if worker else [("scheduler", get_scheduler)]
+    if worker or get_broker() is None:
+        import learninghub
+        seconds["imports"] = sum(learninghub.warm_up(logger=logger).values())
+        steps += [("cache", get_cache), ("font_store", get_font_store), ("browser_pool", get_browser_pool)]
+    for step, init in steps:
+        start = time.perf_counter()
+        init()
+        seconds[step] = time.perf_counter() - start
+    for step, value in seconds.items():
+        REGISTRY.observe("learninghub_startup_seconds", value, step=step)
+    return seconds
+
+
 @sock.route("/websocket")
 def websocket(sock):
+    sock = util.LockedSocket(sock)  # the job's logger sends on it, too
     while True:
         # Wait for client to send the login credentials and the ebook's url.
         message = sock.receive()
         creds = json.loads(message)
+        try:
+            creds["page_range"] = util.parse_page_range(creds.pop("pages", None))
+        except ValueError as e:
+            util.socket_inform_error(sock, str(e))
+            continue
 
-        # Set up tempdir and logging.
-        tmpdir = tempfile.mkdtemp(prefix=f"learninghub2pdf-{datetime.now().isoformat()}-", dir=app.config.get("tmpdir", "/tmp"))
-        logfile = open(f"{tmpdir}/log", "w")
-        socket_logger = util.SocketLogger(sock, logfile)
+        scheduler = get_scheduler()
+        job = scheduler.submit(creds, sock)
+        released_on_expiry = False
+        try:
+            # Allow the client to resume the job after losing the connection.
+            util.socket_inform_job_id(sock, job.id)
 
-        # Use path segment prior to /index.html as filename.
-        output_filename = creds["indexhtml"].split("/")[-2] + ".pdf"
+            # Keep the client informed about its position in the queue.
+            position = None
+            while not job.done.wait(timeout=1):
+                if scheduler.position(job) != position:
+                    position = scheduler.position(job)
+                    util.socket_inform_queue_position(sock, position)
 
-        try:
-            args = {
-                "indexhtml": creds["indexhtml"],
-                "username": creds["username"],
-                "password": creds["password"],
-                "output_filename": output_filename,
-                "output_dir": tmpdir,
-                "temp_dir": tmpdir,
-                "max_pages": app.config.get("debug_max_pages", 1e6),
-                "logger": socket_logger
-            }
-            if app.config.get("debug_learninghub_noop"):
-                mock.ebook2pdf_userpass_learninghub_noop(**args)
+            if job.error is None:
+                # The job's files are kept until the download link expires.
+                token = get_download_tokens().issue(job.output_path, job.output_filename, on_expire=lambda job=job: job.release(sock))
+                released_on_expiry = True
+                util.socket_send_download_link(sock, url_for("download", token=token), job.output_filename)
             else:
-                ebook2pdf_userpass(**args)
-            util.socket_send_file(sock, f"{tmpdir}/{output_filename}")
-            logfile.close()
-            if not app.config.get("debug_no_cleanup"):
-                shutil.rmtree(tmpdir)
-        except Exception as e:
-            # Uncaught exceptions indicate a critical error (most likely the website layout changed).
-            socket_logger.critical(f"Uncaught exception: {traceback.format_exc()}")
-            logfile.close()
-            util.socket_inform_error(sock, "An error occurred. Please reload the page and try again.")
+                util.socket_inform_error(sock, "An error occurred. Please reload the page and try again.")
+        finally:
+            if not released_on_expiry:
+                job.release(sock)
+
+
+@app.route("/download/<token>")
+def download(token):
+    """Streams a converted ebook from disk. Supports range requests, such
+    that interrupted downloads can be resumed."""
+    entry = get_download_tokens().lookup(token)
+    if entry is None:
+        abort(404)
+    filepath, filename = entry
+    return send_file(filepath, mimetype="application/pdf", as_attachment=True, download_name=filename, conditional=True)
@@ -1,22 +1,95 @@
-import base64
+import re
 import json
+import time
+import secrets
+import threading
+from collections import deque
 
 
-def socket_send_file(sock, filepath, filename=None):
-    """Send an encoded file via a flask_sock websocket.
-    
+class DownloadTokens():
+    """Registry of short-lived, unguessable tokens under which files are
+    offered for download via HTTP.
+
+    A token stays valid for 'ttl' seconds, such that interrupted downloads
+    can be resumed using range requests. Afterwards the token is removed and
+    its 'on_expire' callback is run, e.g. to remove the file.
+    """
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self._files = {}  # token -> (filepath, filename)
+        self._lock = threading.Lock()
+
+    def issue(self, filepath, filename, on_expire=None):
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            self._files[token] = (filepath, filename)
+
+        def expire():
+            with self._lock:
+                self._files.pop(token, None)
+            if on_expire is not None:
+                on_expire()
+        timer = threading.Timer(self.ttl, expire)
+        timer.daemon = True
+        timer.start()
+        return token
+
+    def lookup(self, token):
+        """Returns the pair of filepath and filename offered under 'token', or
+        'None' if the token is unknown or expired."""
+        with self._lock:
+            return self._files.get(token)
+
+
+class LockedSocket():
+    """Wraps a flask_sock websocket such that several threads may send on
+    it, e.g. a route and a job's logger. The websocket's own 'send' writes a
+    frame without locking, such that concurrent frames could interleave."""
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def send(self, data):
+        with self._lock:
+            self.sock.send(data)
+
+    def receive(self, timeout=None):
+        return self.sock.receive(timeout)
+
+
+def parse_page_range(text):
+    """Parses a range of pages as entered into the web form, e.g. "12-40",
+    "12-" (until the last page) or "7" (a single page).
+
+    Returns:
+        tuple(int, int): first and last page, the latter 'None' for the
+            ebook's last page. 'None' if 'text' is empty, i.e. all pages.
+
+    Raises:
+        ValueError: if 'text' is not a valid range
+    """
+    text = (text or "").replace(" ", "")
+    if not text:
+        return None
+    match = re.fullmatch(r"(\d+)(?:(-)(\d*))?", text)
+    if match is None:
+        raise ValueError(f"Invalid range of pages '{text}'.")
+    first = int(match.group(1))
+    last = first if match.group(2) is None else (int(match.group(3)) if match.group(3) else None)
+    if first < 1 or (last is not None and last < first):
+        raise ValueError(f"Invalid range of pages '{text}'.")
+    return first, last
+
+
+def socket_send_download_link(sock, url, filename):
+    """Tell a flask_sock websocket's client where to download a file from.
+
     Args:
         sock: flask_sock websocket
-        filepath: system path to file
-        filename: filename to suggest to the recipient. The trailing part of
-            'filepath' is used as a default filename.
+        url: url of the file, relative to the server's root
+        filename: filename to suggest to the recipient
     """
-    if filename is None:
-        filename = filepath.split("/")[-1]
-
-    with open(filepath, "rb") as f:
-        file_b64 = base64.b64encode(f.read()).decode()
-    packet = { "type": "file", "filename": filename, "base64": file_b64 }
+    packet = { "type": "file", "filename": filename, "url": url }
     sock.send(json.dumps(packet))
 
 
@@ -25,31 +98,138 @@ def socket_inform_error(sock, message):
     sock.send(json.dumps(packet))
 
 
+def socket_inform_job_id(sock, job_id):
+    packet = { "type": "job", "id": job_id }
+    sock.send(json.dumps(packet))
+
+
+def socket_inform_queue_position(sock, position):
+    packet = { "type": "queue", "position": position }
+    sock.send(json.dumps(packet))
+
+
 class SocketLogger():
     """Class which provides the basic logging interface (debug(), info, ...)
-    and is used to redirect regular logging statements via a flask_sock
-    websocket.
+    and is used to redirect regular logging statements via flask_sock
+    websockets.
     
     We cannot use regular loggers from the logging library, as these modify
     global state and we'd need one logger per websocket (i.e. one per active
     user of the website).
+
+    Several websockets may be attached, e.g. if clients share a conversion.
+    Websockets which fail to send are detached, such that a disconnected
+    client does not abort the conversion.
+
+    Lines are written to the logfile immediately, but sent by a thread of
+    their own, every 'interval' seconds as a single batched frame, such that
+    a slow client never blocks the conversion. At most 'max_buffered' lines
+    are buffered; beyond that, the oldest lines are dropped and replaced by a
+    note. Per-page progress lines (see 'PROGRESS') are not sent as lines but
+    collapsed into a progress event carrying the latest page and the
+    throughput.
     """
-    def __init__(self, sock, outfile):
-        self.sock = sock  # socket to send logs to
-        self.outfile = outfile  # additional logfile; filehandle must be closed manually
+    # Matches e.g. "Converted page 3/120." and "Converted page 42 (3/20).".
+    PROGRESS = re.compile(r"(Converted|Downloaded) page (\d+)(?:/(\d+)| \((\d+)/(\d+)\))\.$")
 
-    def encode_and_send_line(self, line):
-        packet = { "type": "log", "value": line.replace(" ", "&nbsp;").rstrip() }
-        self.sock.send(json.dumps(packet))
+    def __init__(self, sock, outfile, interval=0.25, max_buffered=1000):
+        self.socks = [sock] if sock is not None else []  # sockets to send logs to
+        self.outfile = outfile  # additional logfile; filehandle must be closed manually
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._lines = deque(maxlen=max_buffered)
+        self._num_dropped = 0
+        self._progress = None  # latest progress event, until it is sent
+        self._progress_start = {}  # stage -> (monotonic time, pages done) of the first progress line
+        self._closed = threading.Event()
+        self._abort = None  # exception raised by every log call, see 'abort'
+        self._sender = threading.Thread(target=self._send_periodically, daemon=True)
+        self._sender.start()
+
+    def add_socket(self, sock):
+        with self.lock:
+            self.socks.append(sock)
+
+    def remove_socket(self, sock):
+        with self.lock:
+            if sock in self.socks:
+                self.socks.remove(sock)
+
+    def _send(self, packet):
+        with self.lock:
+            socks = list(self.socks)
+        for sock in socks:
+            try:
+                sock.send(packet)
+            except Exception:
+                self.remove_socket(sock)
+
+    def flush(self):
+        """Sends the buffered lines and the latest progress event."""
+        with self.lock:
+            lines = list(self._lines)
+            self._lines.clear()
+            if self._num_dropped:
+                lines.insert(0, self.encode_line(f"[WARN] {self._num_dropped} lines omitted, see the logfile."))
+                self._num_dropped = 0
+            progress, self._progress = self._progress, None
+        if lines:
+            self._send(json.dumps({ "type": "logs", "values": lines }))
+        if progress is not None:
+            self._send(json.dumps(progress))
+
+    def _send_periodically(self):
+        while not self._closed.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def close(self, timeout=10):
+        """Stops the sending thread after it sent what is buffered. Waits at
+        most 'timeout' seconds, such that a stalled client cannot hold up the
+        caller (e.g. a scheduler's worker); in that case, all websockets are
+        detached."""
+        self._closed.set()
+        self._sender.join(timeout)
+        if self._sender.is_alive():
+            with self.lock:
+                self.socks = []
+
+    def abort(self, exception):
+        """Makes every further log call raise 'exception'. As a conversion
+        logs at each step, this stops it from another thread."""
+        self._abort = exception
+
+    def _update_progress(self, match):
+        stage = "convert" if match.group(1) == "Converted" else "download"
+        page = int(match.group(2))
+        done, total = (page, int(match.group(3))) if match.group(3) else (int(match.group(4)), int(match.group(5)))
+        now = time.monotonic()
+        start, start_done = self._progress_start.setdefault(stage, (now, done - 1))
+        pages_per_second = (done - start_done) / (now - start) if now > start else None
+        self._progress = {
+            "type": "progress", "stage": stage, "page": page, "done": done, "total": total,
+            "pages_per_second": round(pages_per_second, 2) if pages_per_second is not None else None,
+        }
+
+    def encode_line(self, line):
+        return line.replace(" ", "&nbsp;").rstrip()
 
     def emit(self, prefix, message):
-        self.outfile.write(f"[{prefix}] {message}\n")
-        
+        if self._abort is not None:
+            raise self._abort
         # Split the message into lines for simpler client code.
         lines = message.split("\n")
-        self.encode_and_send_line(f"[{prefix}] {lines[0]}")
-        for line in lines[1:]:
-            self.encode_and_send_line(f"{(len(prefix)+2)*' '} {line}")
+        lines = [f"[{prefix}] {lines[0]}"] + [f"{(len(prefix)+2)*' '} {line}" for line in lines[1:]]
+        match = self.PROGRESS.match(message) if prefix == "INFO" else None
+        with self.lock:
+            self.outfile.write(f"[{prefix}] {message}\n")
+            if match is not None:
+                self._update_progress(match)
+                return
+            for line in lines:
+                if len(self._lines) == self._lines.maxlen:
+                    self._num_dropped += 1
+                self._lines.append(self.encode_line(line))
 
     def debug(self, message):
         self.emit("DEBU", message)
@@ -0,0 +1,151 @@
+"""Benchmarks the conversion of a synthetic ebook served by a local stand-in
+for the learninghub. The browser login is bypassed, everything else (the
+downloads, inkscape and the merge) runs for real.
+
+Usage:
+    python -m bench --pages 200 --page-size 80000 --latency 0.05 --output result.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from PyPDF2 import PdfFileReader
+
+import learninghub
+from learninghub import render
+from learninghub.metrics import JobMetrics
+from bench.server import StandInServer
+
+
+def run_staged(indexhtml, session, num_pages, temp_dir, output_path, args, metrics):
+    svg_dir, pdf_dir, font_dir, image_dir = f"{temp_dir}/svgs", f"{temp_dir}/pdfs", f"{temp_dir}/fonts", f"{temp_dir}/images"
+    for d in (svg_dir, pdf_dir, font_dir, image_dir):
+        os.mkdir(d)
+    with metrics.stage("download_fonts"):
+        learninghub.download_webfonts_css(indexhtml, None, temp_dir, session=session)
+        learninghub.download_webfonts(indexhtml, None, f"{temp_dir}/webFonts.css", font_dir, concurrency=args.download_concurrency, session=session)
+    with metrics.stage("download_pages"):
+        learninghub.download_pages(indexhtml, None, num_pages, svg_dir, concurrency=args.download_concurrency, session=session)
+    if args.optimize_svgs:
+        with metrics.stage("optimize_pages"):
+            learninghub.optimize_pages(svg_dir, image_dir)
+    with metrics.stage("generate_pdfs"):
+        learninghub.generate_pdfs(svg_dir, font_dir, pdf_dir, workers=args.render_workers, batch_size=args.render_batch_size, renderer=args.renderer)
+    with metrics.stage("concatenate_pdfs"):
+        learninghub.concatenate_pdfs(pdf_dir, output_path)
+
+
+def run_streaming(indexhtml, session, num_pages, temp_dir, output_path, args, metrics):
+    svg_dir, pdf_dir, font_dir, image_dir = f"{temp_dir}/svgs", f"{temp_dir}/pdfs", f"{temp_dir}/fonts", f"{temp_dir}/images"
+    for d in (svg_dir, pdf_dir, font_dir, image_dir):
+        os.mkdir(d)
+    with metrics.stage("download_fonts"):
+        learninghub.download_webfonts_css(indexhtml, None, temp_dir, session=session)
+        learninghub.download_webfonts(indexhtml, None, f"{temp_dir}/webFonts.css", font_dir, concurrency=args.download_concurrency, session=session)
+    with metrics.stage("install_fonts"):
+        env = learninghub.install_fonts(font_dir)
+    with metrics.stage("pages"):
+        learninghub.stream_pages_to_pdf(indexhtml, session, num_pages, svg_dir, pdf_dir, output_path,
+                                        download_concurrency=args.download_concurrency, render_workers=args.render_workers,
+                                        render_batch_size=args.render_batch_size, max_in_flight=args.max_in_flight,
+                                        env=env, metrics=metrics, image_dir=image_dir if args.optimize_svgs else None, renderer=args.renderer)
+
+
+def output_pages(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return PdfFileReader(f).getNumPages()
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is reported in kilobytes on Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mode", choices=["streaming", "staged"], default="streaming",
+                        help="'streaming' runs the pipeline used by ebook2pdf_userpass, 'staged' runs download_pages, generate_pdfs and concatenate_pdfs one after another")
+    parser.add_argument("--pages", type=int, default=50, help="number of pages of the synthetic ebook")
+    parser.add_argument("--page-size", type=int, default=50000, help="approximate size of a page's SVG in bytes")
+    parser.add_argument("--fonts", type=int, default=2, help="number of WOFF2 fonts")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each reply of the server is delayed")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum additional random delay in seconds")
+    parser.add_argument("--server-max-concurrent", type=int, default=None, help="parallel requests beyond which the server replies with HTTP 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests the server fails with HTTP 503")
+    parser.add_argument("--download-concurrency", type=int, default=8)
+    parser.add_argument("--renderer", choices=render.RENDERERS, default="inkscape")
+    parser.add_argument("--render-workers", type=int, default=None)
+    parser.add_argument("--render-batch-size", type=int, default=None)
+    parser.add_argument("--max-in-flight", type=int, default=64)
+    parser.add_argument("--optimize-svgs", action="store_true", help="optimize the SVGs before rendering (see learninghub/svgopt.py)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the conversion's log")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="[%(levelname)s] %(message)s")
+
+    metrics = JobMetrics()
+    temp_dir = tempfile.mkdtemp(prefix="learninghub2pdf-bench-")
+    output_path = f"{temp_dir}/ebook.pdf"
+    run = run_streaming if args.mode == "streaming" else run_staged
+    with StandInServer(args.pages, args.page_size, args.fonts, args.latency, args.jitter,
+                       max_concurrent=args.server_max_concurrent, error_rate=args.error_rate) as server:
+        session = learninghub.make_session({}, pool_size=args.download_concurrency)
+        start = time.monotonic()
+        with metrics.stage("total"):
+            run(server.indexhtml, session, args.pages, temp_dir, output_path, args, metrics)
+        elapsed = time.monotonic() - start
+        num_requests = server.num_requests
+        num_rejected = server.num_rejected
+
+    summary = metrics.summary()
+    result = {
+        "revision": git_revision(),
+        "parameters": vars(args),
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(args.pages / elapsed, 2),
+        "requests": num_requests,
+        "rejected_requests": num_rejected,
+        "output_pages": output_pages(output_path),
+        "output_bytes": os.path.getsize(output_path) if os.path.isfile(output_path) else None,
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+        "peak_rss_children_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+        "stage_seconds": summary["stage_seconds"],
+        "page_seconds": summary["page_seconds"],
+    }
+
+    print(f"{args.pages} pages in {result['seconds']} s ({result['pages_per_second']} pages/s), "
+          f"peak RSS {result['peak_rss_mb']} MB (largest child {result['peak_rss_children_mb']} MB)")
+    print(f"  {result['output_pages']} pages in the output, {num_rejected} of {num_requests} requests rejected by the server")
+    for stage, seconds in result["stage_seconds"].items():
+        print(f"  {stage:<18} {seconds:>9.3f} s")
+    for stage, page in result["page_seconds"].items():
+        print(f"  page {stage:<13} {page['mean']:>9.3f} s mean, {page['max']:.3f} s max")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if not args.keep:
+        shutil.rmtree(temp_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Renders the same pages with every available renderer (see
+learninghub/render.py) and compares their speed and output. The fidelity
+check rasterizes the PDFs and requires PyMuPDF and Pillow.
+
+Usage:
+    python -m bench.renderers page1.svg page2.svg ... --fonts fonts/
+    python -m bench.renderers --pages 20 --page-size 80000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import learninghub
+from learninghub import render
+from bench.server import make_svg, make_woff2
+
+
+def rasterize(pdf_path, dpi):
+    """Returns the first page of a PDF as grayscale image, or 'None' if
+    PyMuPDF or Pillow are not installed."""
+    try:
+        import fitz
+        from PIL import Image
+    except ImportError:
+        return None
+    with fitz.open(pdf_path) as document:
+        pixmap = document[0].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+        return Image.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def compare_images(reference, image, threshold=32):
+    """Returns the mean absolute difference of two grayscale images (0-255)
+    and the fraction of pixels differing by more than 'threshold'."""
+    from PIL import ImageChops
+    if image.size != reference.size:
+        image = image.resize(reference.size)
+    histogram = ImageChops.difference(reference, image).histogram()
+    num_pixels = sum(histogram)
+    mean = sum(value * count for value, count in enumerate(histogram)) / num_pixels
+    return round(mean, 3), round(sum(histogram[threshold+1:]) / num_pixels, 5)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.renderers", description=__doc__.split("\n\n")[0])
+    parser.add_argument("svgs", nargs="*", help="SVG files to render; synthetic pages are used if none are given")
+    parser.add_argument("--fonts", help="directory of the WOFF2 fonts the SVG files use")
+    parser.add_argument("--pages", type=int, default=10, help="number of synthetic pages")
+    parser.add_argument("--page-size", type=int, default=50000, help="approximate size of a synthetic page's SVG in bytes")
+    parser.add_argument("--workers", type=int, default=None, help="pages rendered in parallel, defaults to the number of CPUs")
+    parser.add_argument("--batch-size", type=int, default=25, help="pages per inkscape shell")
+    parser.add_argument("--dpi", type=int, default=72, help="resolution of the fidelity check")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix="learninghub2pdf-bench-renderers-")
+    font_dir = f"{temp_dir}/fonts"
+    os.mkdir(font_dir)
+    svgs = args.svgs
+    if svgs and args.fonts:
+        for filename in os.listdir(args.fonts):
+            shutil.copy(f"{args.fonts}/{filename}", font_dir)
+    elif not svgs:
+        with open(f"{font_dir}/font0.woff2", "wb") as f:
+            f.write(make_woff2())
+        for page in range(1, args.pages + 1):
+            with open(f"{temp_dir}/topic{page}.svg", "wb") as f:
+                f.write(make_svg(page, args.page_size))
+        svgs = [f"{temp_dir}/topic{page}.svg" for page in range(1, args.pages + 1)]
+    env = learninghub.install_fonts(font_dir)
+
+    backends = {"inkscape": render.InkscapeRenderer(env)}
+    if render.cairo_available():
+        backends["cairo"] = render.CairoRenderer(env, workers=args.workers)  # no fallback, to see cairo's own failures
+    else:
+        print("cairosvg or the cairo library is not available, only inkscape is measured.")
+
+    results = {}
+    for name, backend in backends.items():
+        out_dir = f"{temp_dir}/{name}"
+        os.mkdir(out_dir)
+        pages = [(svg_path, f"{out_dir}/{ii}.pdf") for ii, svg_path in enumerate(svgs)]
+        batch_size = args.batch_size if name == "inkscape" else 1
+        batches = [pages[ii:ii+batch_size] for ii in range(0, len(pages), batch_size)]
+        start = time.monotonic()
+        failed = {}
+        with ThreadPoolExecutor(max_workers=args.workers or os.cpu_count() or 1) as executor:
+            for errors in executor.map(backend.render, batches):
+                failed.update({svg_path: str(error) for svg_path, error in errors.items()})
+        seconds = time.monotonic() - start
+        backend.close()
+        results[name] = {
+            "seconds": round(seconds, 3),
+            "pages_per_second": round(len(pages) / seconds, 2),
+            "failed": failed,
+            "pdf_bytes": sum(os.path.getsize(pdf_path) for _, pdf_path in pages if os.path.isfile(pdf_path)),
+        }
+
+    if "cairo" in results:
+        differences = []
+        for ii, svg_path in enumerate(svgs):
+            reference = f"{temp_dir}/inkscape/{ii}.pdf"
+            candidate = f"{temp_dir}/cairo/{ii}.pdf"
+            if not (os.path.isfile(reference) and os.path.isfile(candidate)):
+                continue
+            images = rasterize(reference, args.dpi), rasterize(candidate, args.dpi)
+            if None in images:
+                print("PyMuPDF or Pillow is not installed, skip the fidelity check.")
+                break
+            mean, fraction = compare_images(*images)
+            differences.append({"svg": svg_path, "mean_difference": mean, "differing_pixels": fraction})
+        results["cairo"]["fidelity"] = differences
+
+    for name, result in results.items():
+        print(f"{name:<9} {result['seconds']:>8.3f} s  {result['pages_per_second']:>8.2f} pages/s  "
+              f"{result['pdf_bytes']:>10} PDF bytes  {len(result['failed'])} failed")
+    for difference in results.get("cairo", {}).get("fidelity", []):
+        print(f"  {os.path.basename(difference['svg']):<28} mean difference {difference['mean_difference']:>7.3f}, "
+              f"{difference['differing_pixels']:.2%} of the pixels differ")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    shutil.rmtree(temp_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
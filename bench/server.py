@@ -0,0 +1,237 @@
+import io
+import time
+import zlib
+import base64
+import hashlib
+import struct
+import random
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib.woff2 import compress
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+FONT_FAMILY = "BenchSans"
+GLYPHS = "abcdefghijklmnopqrstuvwxyz "
+
+
+def make_woff2():
+    """Returns a minimal WOFF2 font whose glyphs are boxes, covering the
+    characters used by the synthetic pages."""
+    glyph_names = [".notdef"] + [f"uni{ord(c):04X}" for c in GLYPHS]
+    fb = FontBuilder(unitsPerEm=1000, isTTF=True)
+    fb.setupGlyphOrder(glyph_names)
+    fb.setupCharacterMap({ord(c): f"uni{ord(c):04X}" for c in GLYPHS})
+    glyphs = {}
+    for name in glyph_names:
+        pen = TTGlyphPen(None)
+        if name != "uni0020":
+            pen.moveTo((50, 0))
+            pen.lineTo((50, 700))
+            pen.lineTo((450, 700))
+            pen.lineTo((450, 0))
+            pen.closePath()
+        glyphs[name] = pen.glyph()
+    fb.setupGlyf(glyphs)
+    fb.setupHorizontalMetrics({name: (500, 50) for name in glyph_names})
+    fb.setupHorizontalHeader(ascent=800, descent=-200)
+    fb.setupNameTable({"familyName": FONT_FAMILY, "styleName": "Regular"})
+    fb.setupOS2()
+    fb.setupPost()
+    ttf = io.BytesIO()
+    fb.save(ttf)
+    ttf.seek(0)
+    woff2 = io.BytesIO()
+    compress(ttf, woff2)
+    return woff2.getvalue()
+
+
+def make_png(width=64, height=64):
+    """Returns an opaque PNG image of the given size as bytes."""
+    raw = b"".join(b"\x00" + b"".join(bytes((x * 4 % 256, y * 4 % 256, 128)) for x in range(width)) for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+LOGO = base64.b64encode(make_png()).decode()
+
+
+def make_svg(page, size, seed=0):
+    """Returns a synthetic A4 page of roughly 'size' bytes, consisting of text
+    set in the benchmark font and filled paths.
+
+    Like the learninghub's pages, each page carries definitions which are
+    never used, a logo embedded as base64 PNG and repeated on every page, and
+    coordinates with more decimals than rendering needs."""
+    rng = random.Random(seed * 100003 + page)
+    parts = [
+        '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="595" height="842" viewBox="0 0 595 842">',
+        '<defs>',
+        '<linearGradient id="header"><stop offset="0" stop-color="#dde"/><stop offset="1" stop-color="#fff"/></linearGradient>',
+        *(f'<clipPath id="clip{ii}"><rect x="{rng.uniform(0, 595):.6f}" y="{rng.uniform(0, 842):.6f}" width="100" height="100"/></clipPath>' for ii in range(20)),
+        '</defs>',
+        '<rect x="0" y="0" width="595" height="80" fill="url(#header)"/>',
+        f'<image x="500" y="10" width="64" height="64" xlink:href="data:image/png;base64,{LOGO}"/>',
+        f'<text x="40" y="60" font-family="{FONT_FAMILY}" font-size="24">page {page}</text>',
+    ]
+    length = sum(map(len, parts))
+    while length < size:
+        if rng.random() < 0.5:
+            words = " ".join("".join(rng.choice(GLYPHS[:-1]) for _ in range(rng.randint(2, 9))) for _ in range(8))
+            part = f'<text x="{rng.uniform(20, 300):.6f}" y="{rng.uniform(80, 820):.6f}" font-family="{FONT_FAMILY}" font-size="11">{words}</text>'
+        else:
+            points = " ".join(f"{rng.uniform(0, 595):.6f},{rng.uniform(0, 842):.6f}" for _ in range(6))
+            part = f'<path d="M {points} Z" fill="#{rng.randrange(1 << 24):06x}" fill-opacity="0.3"/>'
+        parts.append(part)
+        length += len(part)
+    parts.append("</svg>")
+    return "\n".join(parts).encode()
+
+
+class StandInServer():
+    """Local HTTP server mimicking a learninghub ebook's resources, i.e.
+    'book/index.html', 'book/xml/topicN.svg', 'book/css/webFonts.css' and the
+    WOFF2 fonts it refers to.
+
+    Replies carry an ETag, and requests with a matching 'If-None-Match'
+    header are answered with HTTP 304. 'change_pages' mimics a publisher
+    revising pages.
+
+    Every reply is delayed by 'latency' seconds plus a uniformly distributed
+    jitter of up to 'jitter' seconds. Pages are generated on first access and
+    kept in memory.
+
+    To mimic a loaded server, requests beyond 'max_concurrent' parallel ones
+    are answered with HTTP 429 and a 'Retry-After' header, and a fraction
+    'error_rate' of the requests fails with HTTP 503.
+    """
+    def __init__(self, num_pages=50, page_size=50000, num_fonts=2, latency=0.0, jitter=0.0, max_concurrent=None, error_rate=0.0, port=0):
+        self.num_pages = num_pages
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.max_concurrent = max_concurrent
+        self.error_rate = error_rate
+        self.num_requests = 0
+        self.num_rejected = 0
+        self._in_flight = 0
+        self._pages = {}
+        self._revisions = {}  # page -> number of changes
+        self._lock = threading.Lock()
+        woff2 = make_woff2()
+        self._fonts = {f"fonts/font{ii}.woff2": woff2 for ii in range(num_fonts)}
+        self._css = "\n".join(
+            f"@font-face {{ font-family: '{FONT_FAMILY}'; src: url('{path}') format('woff2'); }}"
+            for path in self._fonts
+        ).encode()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def indexhtml(self):
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}/book/index.html"
+
+    def _page(self, page):
+        with self._lock:
+            if page not in self._pages:
+                self._pages[page] = make_svg(page, self.page_size, seed=self._revisions.get(page, 0))
+            return self._pages[page]
+
+    def change_pages(self, pages):
+        """Changes the content of the given pages."""
+        with self._lock:
+            for page in pages:
+                self._revisions[page] = self._revisions.get(page, 0) + 1
+                self._pages.pop(page, None)
+
+    def _body(self, path):
+        """Returns the content type and body served under 'path', or 'None'."""
+        if path == "/book/index.html":
+            return "text/html", b"<html><body>stand-in ebook</body></html>"
+        if path == "/book/css/webFonts.css":
+            return "text/css", self._css
+        if path.startswith("/book/css/") and path[10:] in self._fonts:
+            return "font/woff2", self._fonts[path[10:]]
+        if path.startswith("/book/xml/topic") and path.endswith(".svg"):
+            try:
+                page = int(path[15:-4])
+            except ValueError:
+                return None
+            if 1 <= page <= self.num_pages:
+                return "image/svg+xml", self._page(page)
+        return None
+
+    def _handle(self, request):
+        with self._lock:
+            self.num_requests += 1
+            overloaded = self.max_concurrent is not None and self._in_flight >= self.max_concurrent
+            failing = random.random() < self.error_rate
+            if overloaded or failing:
+                self.num_rejected += 1
+            else:
+                self._in_flight += 1
+        if overloaded:
+            request.send_response(429)
+            request.send_header("Retry-After", "1")
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+        if failing:
+            request.send_error(503)
+            return
+        try:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        result = self._body(request.path)
+        if result is None:
+            request.send_error(404)
+            return
+        content_type, body = result
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if request.headers.get("If-None-Match") == etag:
+            request.send_response(304)
+            request.send_header("ETag", etag)
+            request.end_headers()
+            return
+        request.send_response(200)
+        request.send_header("ETag", etag)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
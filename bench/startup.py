@@ -0,0 +1,78 @@
+"""Measures the server's time to ready. Imports the app in a fresh
+interpreter with '-X importtime' and summarizes where the time goes per
+top-level package, then measures the dependencies which are deferred to the
+warm-up (or the first conversion).
+
+Usage:
+    python -m bench.startup
+    python -m bench.startup --top 20 --output startup.json
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+# Format of '-X importtime': "import time: <self us> | <cumulative us> | <indented name>"
+IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    """Imports a module in a fresh interpreter and returns the import time in
+    seconds of every top-level package it pulls in, largest first. A
+    package's time sums its modules' own time, excluding the packages they
+    import in turn."""
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             cwd=ROOT, capture_output=True, text=True, check=True)
+    packages = {}
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if match is None:
+            continue
+        own, _, _, name = match.groups()
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + int(own) / 1e6
+    return dict(sorted(packages.items(), key=lambda item: -item[1]))
+
+
+def deferred_times():
+    """Imports the app and then runs 'learninghub.warm_up' in a fresh
+    interpreter, and returns the seconds spent on each deferred import."""
+    script = "import json, app, learninghub; print(json.dumps(learninghub.warm_up()))"
+    process = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.startup", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--module", default="app", help="module whose import is measured")
+    parser.add_argument("--top", type=int, default=10, help="number of packages listed")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    packages = import_times(args.module)
+    deferred = deferred_times()
+    results = {
+        "import_seconds": round(sum(packages.values()), 4),
+        "packages": {name: round(seconds, 4) for name, seconds in packages.items()},
+        "deferred_seconds": round(sum(deferred.values()), 4),
+        "deferred": {name: round(seconds, 4) for name, seconds in deferred.items()},
+    }
+
+    print(f"import {args.module}: {results['import_seconds']:.3f} s")
+    for name, seconds in list(packages.items())[:args.top]:
+        print(f"  {name:<48} {seconds:>8.3f} s")
+    print(f"deferred to the warm-up or the first conversion: {results['deferred_seconds']:.3f} s")
+    for name, seconds in deferred.items():
+        print(f"  {name:<48} {seconds:>8.3f} s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
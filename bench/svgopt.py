@@ -0,0 +1,80 @@
+"""Renders pages with inkscape as served and after optimization (see
+learninghub/svgopt.py) and reports the bytes and render time saved per page.
+
+Usage:
+    python -m bench.svgopt page1.svg page2.svg ...
+    python -m bench.svgopt --pages 20 --page-size 80000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from learninghub import render
+from learninghub.svgopt import optimize_svg
+from bench.server import make_svg
+
+
+def timed_render(svg_path, pdf_path):
+    start = time.monotonic()
+    error = render.render_page(svg_path, pdf_path)
+    if error:
+        raise RuntimeError(f"Error rendering '{svg_path}'.\n{error}")
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.svgopt", description=__doc__.split("\n\n")[0])
+    parser.add_argument("svgs", nargs="*", help="SVG files to compare; synthetic pages are used if none are given")
+    parser.add_argument("--pages", type=int, default=10, help="number of synthetic pages")
+    parser.add_argument("--page-size", type=int, default=50000, help="approximate size of a synthetic page's SVG in bytes")
+    parser.add_argument("--precision", type=int, default=3, help="decimals kept of coordinates and lengths")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix="learninghub2pdf-bench-svgopt-")
+    image_dir = f"{temp_dir}/images"
+    os.mkdir(image_dir)
+    svgs = args.svgs
+    if not svgs:
+        for page in range(1, args.pages + 1):
+            with open(f"{temp_dir}/topic{page}.svg", "wb") as f:
+                f.write(make_svg(page, args.page_size))
+        svgs = [f"{temp_dir}/topic{page}.svg" for page in range(1, args.pages + 1)]
+
+    results = []
+    for ii, svg_path in enumerate(svgs):
+        optimized_path = f"{temp_dir}/{ii}.optimized.svg"
+        start = time.monotonic()
+        stats = optimize_svg(svg_path, optimized_path, image_dir=image_dir, precision=args.precision)
+        optimize_seconds = time.monotonic() - start
+        render_seconds = timed_render(svg_path, f"{temp_dir}/{ii}.pdf")
+        optimized_render_seconds = timed_render(optimized_path, f"{temp_dir}/{ii}.optimized.pdf")
+        results.append({
+            "svg": svg_path,
+            **stats,
+            "pdf_bytes": os.path.getsize(f"{temp_dir}/{ii}.pdf"),
+            "optimized_pdf_bytes": os.path.getsize(f"{temp_dir}/{ii}.optimized.pdf"),
+            "optimize_seconds": round(optimize_seconds, 3),
+            "render_seconds": round(render_seconds, 3),
+            "optimized_render_seconds": round(optimized_render_seconds, 3),
+        })
+
+    print(f"{'page':<28} {'svg bytes saved':>16} {'pdf bytes saved':>16} {'render s saved':>15} {'optimize s':>11}")
+    for result in results:
+        print(f"{os.path.basename(result['svg']):<28} {result['bytes_in'] - result['bytes_out']:>16} "
+              f"{result['pdf_bytes'] - result['optimized_pdf_bytes']:>16} "
+              f"{result['render_seconds'] - result['optimized_render_seconds']:>15.3f} {result['optimize_seconds']:>11.3f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    shutil.rmtree(temp_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,55 +1,231 @@
 import re
+import json
 import os
-import math
-import shutil
 import subprocess
+import shutil
 import logging
 import random
 import time
-
-from fontTools.ttLib.woff2 import decompress
-from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
-from PyPDF2 import PdfFileMerger, PdfFileReader
-import requests
+import hashlib
+import importlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from learninghub import render
+from learninghub.browsers import LOGIN_WAIT_SECONDS, launch_browser
+from learninghub.cache import file_digest
+from learninghub.fonts import write_fontconfig
+from learninghub.sessions import probe_num_pages
+from learninghub.pipeline import PageError, run_pipeline
+from learninghub.metrics import JobMetrics
+from learninghub.manifest import Manifest
+from learninghub.fetch import FetchController
+from learninghub.svgopt import optimize_svg
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
-def ebook2pdf_userpass(indexhtml, username, password, output_filename="ebook.pdf", output_dir=None, temp_dir=None, max_pages=1e6, logger=logger):
+HEAVY_MODULES = (
+    "requests",
+    "PyPDF2",
+    "fontTools.ttLib.woff2",
+    "selenium.webdriver",
+    "selenium.webdriver.support.ui",
+    "selenium.webdriver.support.expected_conditions",
+    "learninghub.merge",
+)
+
+
+def warm_up(logger=logger):
+    """Imports the dependencies which are otherwise loaded by the first
+    conversion, such that it does not pay for them. Safe to call from a
+    background thread while the server is already accepting requests.
+
+    selenium, PyPDF2, fontTools and requests take a substantial part of the
+    server's startup time to import. Hence, they are not imported at module
+    level, but by the functions which use them, such that they are loaded on
+    first use or by this function.
+
+    Returns:
+        dict: seconds spent importing each module of 'HEAVY_MODULES'. Modules
+            which were already imported take (almost) no time.
+    """
+    seconds = {}
+    for name in HEAVY_MODULES:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        seconds[name] = time.perf_counter() - start
+    logger.debug(f"Imported the conversion's dependencies in {sum(seconds.values()):.3f} s.")
+    return seconds
+
+
+def ebook2pdf_userpass(indexhtml, username, password, output_filename="ebook.pdf", output_dir=None, temp_dir=None, max_pages=1e6, download_concurrency=1, render_workers=None, render_batch_size=None, max_pages_in_flight=32, cache=None, session_cache=None, browser_pool=None, font_store=None, metrics=None, checkpoint=False, fetch_retries=5, optimize_svgs=False, renderer="inkscape", first_page=1, last_page=None, incremental=False, logger=logger):
     """Generate PDF from a learninghub ebook. The ebook is accessed via
     username and password.
 
+    The fonts are downloaded and installed first. Afterwards, the pages are
+    streamed through download, conversion and concatenation (see
+    'stream_pages_to_pdf').
+
     Args:
         temp_dir (str): System path of directory where temporary files such as
             downloaded fonts and SVGs will be stored. Further subdirectories
             may be created. Directory must exist and must be empty (use one
             temporary directory per conversion).
+        download_concurrency (int): maximum number of pages and fonts which
+            are downloaded in parallel.
+        render_workers (int): number of inkscape processes running in
+            parallel. Defaults to the number of CPUs.
+        render_batch_size (int): number of pages converted per inkscape shell.
+            If 'None' is passed, one inkscape process is started per page.
+        max_pages_in_flight (int): maximum number of pages which have been
+            downloaded but not yet concatenated.
+        cache (learninghub.cache.Cache): cache shared between conversions. If
+            the requested book has been converted completely before, it is
+            copied from the cache without downloading or converting anything.
+        session_cache (learninghub.sessions.SessionCache): cache of the
+            users' cookies which allows to skip the browser login.
+        browser_pool (learninghub.browsers.BrowserPool): pool of warm browsers
+            used if a browser login is necessary.
+        font_store (learninghub.fonts.FontStore): store of decompressed fonts
+            shared between conversions.
+        metrics (learninghub.metrics.JobMetrics): collects the conversion's
+            timings and counters, which are logged at the end. If 'None' is
+            passed, a new instance is used.
+        checkpoint (bool): record the progress in 'manifest.json' inside
+            'temp_dir' and keep the per-page PDFs until the conversion is
+            done. Calling the function again with the same 'temp_dir' resumes
+            the conversion, redoing only the missing pages. In this case
+            'temp_dir' need not be empty. As the per-page PDFs are kept,
+            the temporary disk usage grows with the ebook rather than being
+            bounded by 'max_pages_in_flight'.
+        fetch_retries (int): number of retries of a download failing
+            transiently (e.g. with HTTP 429 or 503) before the page or font
+            is skipped.
+        optimize_svgs (bool): shrink the pages' SVGs before rendering (see
+            'learninghub.svgopt.optimize_svg').
+        renderer (str): 'inkscape', or 'cairo' to render the pages in-process
+            using cairosvg with inkscape as fallback (see
+            'learninghub.render.make_renderer').
+        first_page (int): first page to convert (1-based).
+        last_page (int): last page to convert. Defaults to the ebook's last
+            page (or 'max_pages').
+        incremental (bool): if the requested pages have been converted
+            before, revalidate the cached pages with the server instead of
+            reusing the cached PDF as is, and convert only the pages which
+            changed. Unchanged pages are copied from the cached PDF. A page is
+            unchanged if the server confirms the SVG which the cached PDF's
+            page was converted from. Requires 'cache'.
     """
+    if first_page < 1 or (last_page is not None and last_page < first_page):
+        raise ValueError(f"Invalid range of pages {first_page}-{last_page}.")
 
     logger.info(f"Create temporary directories under '{temp_dir}'.")
     screenshot_dir = f"{temp_dir}/screenshots"
     svg_dir = f"{temp_dir}/svgs"
     pdf_dir = f"{temp_dir}/pdfs"
     font_dir = f"{temp_dir}/fonts"
-    os.mkdir(screenshot_dir)
-    os.mkdir(svg_dir)
-    os.mkdir(pdf_dir)
-    os.mkdir(font_dir)
+    image_dir = f"{temp_dir}/images" if optimize_svgs else None
+    os.makedirs(screenshot_dir, exist_ok=checkpoint)
+    os.makedirs(svg_dir, exist_ok=checkpoint)
+    os.makedirs(pdf_dir, exist_ok=checkpoint)
+    os.makedirs(font_dir, exist_ok=checkpoint)
+    if image_dir is not None:
+        os.makedirs(image_dir, exist_ok=checkpoint)
+
+    output_path = f"{output_dir}/{output_filename}"
+    manifest = Manifest(f"{temp_dir}/manifest.json") if checkpoint else None
+    page_range = (first_page, last_page) if (first_page, last_page) != (1, None) else None
+    if manifest is not None and manifest.is_done(indexhtml, page_range) and os.path.isfile(output_path):
+        logger.info(f"Resume a completed conversion. Done: '{output_path}'")
+        return
+
+    if metrics is None:
+        metrics = JobMetrics()
+    try:
+        with metrics.stage("total"):
+            with metrics.stage("login"):
+                cookies, num_pages = acquire_cookies_and_numpages_cached(indexhtml, username, password, session_cache, screenshot_dir=screenshot_dir, browser_pool=browser_pool, logger=logger)
+            num_pages = int(min(num_pages, max_pages))
+            pages = list(range(first_page, min(last_page or num_pages, num_pages)+1))
+            if not pages:
+                raise ValueError(f"The ebook has only {num_pages} pages.")
+            if manifest is not None:
+                manifest.begin(indexhtml, num_pages, page_range)
+            book_key = ("book", indexhtml, num_pages) if page_range is None else ("book", indexhtml, num_pages, pages[0], pages[-1])
+            base_pdf, base_pages = None, {}
+            if cache is not None and incremental:
+                if cache.get(book_key, f"{temp_dir}/previous.pdf"):
+                    base_pdf = f"{temp_dir}/previous.pdf"
+                    base_pages = {int(page): record for page, record in (cache.meta(book_key) or {}).get("pages", {}).items()}
+                    logger.info("Revalidate the pages of the cached ebook.")
+            elif cache is not None and cache.get(book_key, output_path):
+                metrics.inc("learninghub_cache_hits_total", kind="book")
+                logger.info(f"Use cached ebook. Done: '{output_path}'")
+                return
+
+            session = make_session(cookies, pool_size=download_concurrency)
+            fetcher = FetchController(session, max_concurrency=download_concurrency, max_retries=fetch_retries, metrics=metrics)
+            if manifest is not None and manifest.has_stage("download_fonts"):
+                logger.info("Resume with the fonts downloaded previously.")
+            else:
+                with metrics.stage("download_fonts"):
+                    download_webfonts_css(indexhtml, cookies, temp_dir, session=session, cache=cache, fetcher=fetcher, logger=logger)
+                    download_webfonts(indexhtml, cookies, f"{temp_dir}/webFonts.css", font_dir, concurrency=download_concurrency, session=session, cache=cache, fetcher=fetcher, logger=logger)
+                metrics.inc("learninghub_bytes_total", sum(os.path.getsize(f"{font_dir}/{f}") for f in os.listdir(font_dir)), kind="font")
+                if manifest is not None:
+                    manifest.complete_stage("download_fonts")
+            with metrics.stage("install_fonts"):
+                env = install_fonts(font_dir, font_store=font_store, logger=logger)
+            page_records = {}
+            with metrics.stage("pages"):
+                num_skipped = stream_pages_to_pdf(indexhtml, session, num_pages, svg_dir, pdf_dir, output_path,
+                                                  download_concurrency=download_concurrency, render_workers=render_workers, render_batch_size=render_batch_size,
+                                                  max_in_flight=max_pages_in_flight, cache=cache, env=env, metrics=metrics, manifest=manifest, fetcher=fetcher, image_dir=image_dir, renderer=renderer,
+                                                  pages=pages, revalidate=incremental, base_pdf=base_pdf, base_pages=base_pages, page_records=page_records, logger=logger)
+            if cache is not None and num_skipped == 0:
+                cache.put(book_key, output_path, meta={"pages": page_records})
+            if manifest is not None and num_skipped == 0:
+                manifest.complete_stage("done")
+    except Exception:
+        metrics.inc("learninghub_jobs_total", outcome="failure")
+        raise
+    else:
+        metrics.inc("learninghub_jobs_total", outcome="success")
+    finally:
+        logger.info(f"Metrics: {json.dumps(metrics.summary())}")
 
-    cookies, num_pages = acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=screenshot_dir, logger=logger)
-    download_pages(indexhtml, cookies, min(num_pages, max_pages), svg_dir, logger=logger)
-    download_webfonts_css(indexhtml, cookies, temp_dir, logger=logger)
-    download_webfonts(indexhtml, cookies, f"{temp_dir}/webFonts.css", font_dir, logger=logger)
-    generate_pdfs(svg_dir, font_dir, pdf_dir, logger=logger)
-    concatenate_pdfs(pdf_dir, f"{output_dir}/{output_filename}", logger=logger)
 
+def acquire_cookies_and_numpages_cached(indexhtml, username, password, session_cache, screenshot_dir=None, browser_pool=None, logger=logger):
+    """Like 'acquire_cookies_and_numpages', but reuses the user's cookies from
+    a previous login if they are cached and still grant access to the ebook.
+    In that case the number of pages is determined by probing the ebook's
+    pages, and no browser is started.
 
-def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=None, logger=logger):
+    Args:
+        session_cache (learninghub.sessions.SessionCache): cache of the users'
+            cookies. If 'None' is passed, the browser login is always used.
+
+    Returns:
+        tuple(dict, int): see 'acquire_cookies_and_numpages'
+    """
+    if session_cache is not None:
+        cookies = session_cache.get(username, password)
+        if cookies is not None:
+            logger.info("Reuse the cookies of a previous login and probe the number of pages.")
+            num_pages = probe_num_pages(make_session(cookies), indexhtml)
+            if num_pages > 0:
+                logger.info(f"Found {num_pages} pages.")
+                return cookies, num_pages
+            logger.info("Cached cookies do not grant access to the ebook, or probing the number of pages failed. Login using the browser.")
+            session_cache.invalidate(username)
+
+    cookies, num_pages = acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=screenshot_dir, browser_pool=browser_pool, logger=logger)
+    if session_cache is not None:
+        session_cache.put(username, password, cookies)
+    return cookies, num_pages
+
+
+def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=None, browser_pool=None, logger=logger):
     """Returns the cookies necessary to directly access a learninghub ebook's
     pages and font files. Additionally, returns the ebook's number of pages.
 
@@ -66,6 +242,9 @@ def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=N
         screenshot_dir (str): system path to the screenshots' output directory.
             Directory must exist. If 'None' is passed, no screenshots will be
             taken.
+        browser_pool (learninghub.browsers.BrowserPool): pool to check out a
+            warm browser from. If 'None' is passed, a browser is started and
+            closed for this login.
 
     Returns:
         tuple(dict, int): a pair of a dictionary usable by the cookies
@@ -73,14 +252,25 @@ def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=N
             pages.
     """
 
-    browser_options = Options()
-    browser_options.add_argument("--headless")
-    browser_options.add_argument("--no-sandbox")  # Required to run inside docker
-    browser_options.add_argument("--disable-gpu")  # Required to run inside docker
-    browser_options.add_argument("--disable-dev-shm-usage")  # Alternatively to this flag, map /dev/shm into the container.
-    if screenshot_dir:
-        browser_options.add_argument("window-size=2048x4096")  # Set a large window size for snapshots to capture all relevant content.
-    driver = webdriver.Chrome(options=browser_options)
+    if browser_pool is not None:
+        with browser_pool.browser() as driver:
+            return _login_and_export(driver, indexhtml, username, password, screenshot_dir, logger)
+
+    driver = launch_browser(large_window=bool(screenshot_dir))
+    try:
+        return _login_and_export(driver, indexhtml, username, password, screenshot_dir, logger)
+    finally:
+        logger.info("Close the Browser.")
+        driver.quit()
+
+
+def _login_and_export(driver, indexhtml, username, password, screenshot_dir, logger):
+    from selenium.webdriver.common.keys import Keys
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
+    driver.set_page_load_timeout(LOGIN_WAIT_SECONDS)
     driver.get("https://learninghub.sap.com/login")
 
     # Helper to take screenshots.
@@ -104,7 +294,7 @@ def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=N
     #       as the latter sometimes raises a 'ElementNotInteractableException'.
     logger.info("Enter username and confirm.")
     snooze()
-    username_input = WebDriverWait(driver, timeout=90).until(
+    username_input = WebDriverWait(driver, timeout=LOGIN_WAIT_SECONDS).until(
         EC.element_to_be_clickable((By.ID, "j_username"))
     )
     take_snapshot()
@@ -114,7 +304,7 @@ def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=N
     username_input.send_keys(Keys.RETURN)
 
     logger.info("Enter password and confirm.")
-    password_input = WebDriverWait(driver, timeout=90).until(
+    password_input = WebDriverWait(driver, timeout=LOGIN_WAIT_SECONDS).until(
         EC.element_to_be_clickable((By.ID, "password"))
     )
     take_snapshot()
@@ -124,7 +314,7 @@ def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=N
     password_input.send_keys(Keys.RETURN)
 
     logger.info("Click the 'Reject All' button.")
-    reject_button = WebDriverWait(driver, timeout=90).until(
+    reject_button = WebDriverWait(driver, timeout=LOGIN_WAIT_SECONDS).until(
         EC.element_to_be_clickable((By.ID, "truste-consent-required"))
     )
     take_snapshot()
@@ -138,7 +328,7 @@ def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=N
     # Clicking this link will open a new tab, which, for the sake of simplicity,
     # we circumvent by retrieving the link target and navigating there ourselves.
     logger.info("Click the 'Browse content' button.")
-    browse_content_link = WebDriverWait(driver, timeout=90).until(
+    browse_content_link = WebDriverWait(driver, timeout=LOGIN_WAIT_SECONDS).until(
         # TODO: Find link by some property other than link text, as that could
         #       differ between users whose locales differ. This element has no Id.
         EC.element_to_be_clickable((By.LINK_TEXT, "Browse content"))
@@ -146,7 +336,7 @@ def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=N
     take_snapshot()
     target = browse_content_link.get_attribute("href")
     driver.get(target)
-    WebDriverWait(driver, timeout=90).until(
+    WebDriverWait(driver, timeout=LOGIN_WAIT_SECONDS).until(
         EC.presence_of_element_located((By.ID, "bizx-shared-header"))
     )
     take_snapshot()
@@ -162,18 +352,86 @@ def acquire_cookies_and_numpages(indexhtml, username, password, screenshot_dir=N
     cookies = {c["name"]: c["value"] for c in driver.get_cookies()}  # format understood by requests package
 
     logger.info("Retrieve the number of pages.")
-    pages_indicator = WebDriverWait(driver, timeout=90).until(
+    pages_indicator = WebDriverWait(driver, timeout=LOGIN_WAIT_SECONDS).until(
         EC.element_to_be_clickable((By.ID, "progressIndicator"))
     )
     num_pages = int(re.search("[0-9]+", pages_indicator.text)[0])  # text is slash followed by whitespace and the number of pages (e.g. '/ 450')
 
-    logger.info("Close the Browser.")
-    driver.quit()
-
     return cookies, num_pages
 
 
-def download_pages(indexhtml, cookies, num_pages, output_dir, logger=logger):
+def make_session(cookies, pool_size=1):
+    """Returns a requests session which carries the ebook's cookies and keeps
+    its connections to the learninghub alive, such that consecutive requests
+    do not pay for a new TCP and TLS handshake each.
+
+    Args:
+        cookies (dict): cookies required to access the ebook's resources
+        pool_size (int): maximum number of connections kept alive per host.
+            Should be at least the number of threads sharing the session.
+
+    Returns:
+        requests.Session
+    """
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.cookies.update(cookies)
+    return session
+
+
+def fetch_concurrently(session, urls, concurrency=1, fetcher=None):
+    """Downloads a set of urls using a pool of threads sharing a single
+    session. Transient failures are retried (see
+    'learninghub.fetch.FetchController').
+
+    Results are yielded in order of completion and are consumed by the calling
+    thread, such that loggers and file handles need not be thread-safe.
+
+    Args:
+        session (requests.Session): session used for all requests
+        urls (dict): mapping of arbitrary keys to the urls to download
+        concurrency (int): maximum number of requests in flight
+        fetcher (learninghub.fetch.FetchController): controller to issue the
+            requests through. If 'None' is passed, one is created for
+            'session'.
+
+    Yields:
+        tuple(object, requests.Response): pairs of key and reply. The reply is
+            'None' if the request failed on the connection level.
+    """
+    import requests
+    if fetcher is None:
+        fetcher = FetchController(session, max_concurrency=concurrency)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(fetcher.get, url): key for key, url in urls.items()}
+        for future in as_completed(futures):
+            try:
+                reply = future.result()
+            except requests.RequestException:
+                reply = None
+            yield futures[future], reply
+
+
+def page_filename(page, num_pages, extension):
+    """Returns the zero-padded filename of an ebook's page, such that the
+    lexicographical order of the filenames matches the order of the pages.
+
+    Args:
+        page (int): 1-based page number
+        num_pages (int): number of pages in the ebook
+        extension (str): file extension without the leading dot
+
+    Returns:
+        str
+    """
+    padding = len(str(num_pages))  # number of digits to pad to
+    return f"{str(page).rjust(padding, '0')}.{extension}"
+
+
+def download_pages(indexhtml, cookies, num_pages, output_dir, concurrency=1, session=None, fetcher=None, logger=logger):
     """Downloads an ebook's individual pages as SVG-files.
 
     Args:
@@ -182,25 +440,30 @@ def download_pages(indexhtml, cookies, num_pages, output_dir, logger=logger):
         num_pages (int): number of pages in the ebook
         output_dir (str): system path to the output directory. Directory must
             exist.
+        concurrency (int): maximum number of pages downloaded in parallel
+        session (requests.Session): session to reuse for the downloads. If
+            'None' is passed, a new session is created from 'cookies'.
+        fetcher (learninghub.fetch.FetchController): controller to issue the
+            requests through
 
     Returns:
         None
     """
-    logger.info("Download the ebook's pages as individual SVG files.")
+    logger.info(f"Download the ebook's pages as individual SVG files (up to {concurrency} in parallel).")
     baseurl = indexhtml[:-11]
-    padding = math.ceil(math.log10(num_pages))  # number of digits to pad to
-    for ii in range(1, num_pages+1):
-        url = f"{baseurl}/xml/topic{ii}.svg"
-        logger.info(f"Download page {ii}/{num_pages}.")
-        reply = requests.get(url, cookies=cookies)
-        if reply.ok:
-            with open(f"{output_dir}/{str(ii).rjust(padding, '0')}.svg", "w") as f:  # lpad filename with zeros
+    if session is None:
+        session = make_session(cookies, pool_size=concurrency)
+    urls = {ii: f"{baseurl}/xml/topic{ii}.svg" for ii in range(1, num_pages+1)}
+    for num_done, (ii, reply) in enumerate(fetch_concurrently(session, urls, concurrency, fetcher=fetcher), start=1):
+        if reply is not None and reply.ok:
+            with open(f"{output_dir}/{page_filename(ii, num_pages, 'svg')}", "w") as f:
                 f.write(reply.text)
+            logger.info(f"Downloaded page {ii} ({num_done}/{num_pages}).")
         else:
-            logger.warning(f"Error downloading ebook page {ii} from '{url}'. Skipping page.")
+            logger.warning(f"Error downloading ebook page {ii} from '{urls[ii]}'. Skipping page.")
 
 
-def download_webfonts_css(indexhtml, cookies, output_dir, logger=logger):
+def download_webfonts_css(indexhtml, cookies, output_dir, session=None, cache=None, fetcher=None, logger=logger):
     """Downloads an ebook's 'webFonts.css' file.
 
     Args:
@@ -208,19 +471,35 @@ def download_webfonts_css(indexhtml, cookies, output_dir, logger=logger):
         cookies (dict): cookies required to access the ebook's resources
         output_dir (str): system path to the output directory. Directory must
             exist.
+        session (requests.Session): session to reuse for the download. If
+            'None' is passed, a new session is created from 'cookies'.
+        cache (learninghub.cache.Cache): cache to look up and store the file
+        fetcher (learninghub.fetch.FetchController): controller to issue the
+            request through
 
     Returns:
         None
     """
+    output_path = f"{output_dir}/webFonts.css"
+    if cache is not None and cache.get(("css", indexhtml), output_path):
+        logger.info("Use cached webFonts.css.")
+        return
+
     logger.info("Download webFonts.css.")
     baseurl = indexhtml[:-11]
-    reply = requests.get(f"{baseurl}/css/webFonts.css", cookies=cookies)
+    if session is None:
+        session = make_session(cookies)
+    if fetcher is None:
+        fetcher = FetchController(session)
+    reply = fetcher.get(f"{baseurl}/css/webFonts.css")
     webfonts_css = reply.text
-    with open(f"{output_dir}/webFonts.css", "w") as f:
+    with open(output_path, "w") as f:
         f.write(webfonts_css)
+    if cache is not None and reply.ok:
+        cache.put(("css", indexhtml), output_path)
 
 
-def download_webfonts(indexhtml, cookies, webfonts_css, output_dir, logger=logger):
+def download_webfonts(indexhtml, cookies, webfonts_css, output_dir, concurrency=1, session=None, cache=None, fetcher=None, logger=logger):
     """Downloads fonts listed in the 'webFonts.css' file.
 
     Args:
@@ -228,8 +507,12 @@ def download_webfonts(indexhtml, cookies, webfonts_css, output_dir, logger=logge
         cookies (dict): cookies required to access the ebook's resources
         webfonts_css (str): system path to the downloaded 'webFonts.css' file
         output_dir (str): system path to the output directory. Directory must exist.
-
-
+        concurrency (int): maximum number of fonts downloaded in parallel
+        session (requests.Session): session to reuse for the downloads. If
+            'None' is passed, a new session is created from 'cookies'.
+        cache (learninghub.cache.Cache): cache to look up and store the fonts
+        fetcher (learninghub.fetch.FetchController): controller to issue the
+            requests through
     """
     logger.info("Extract the fonts' urls from webFonts.css.")
     baseurl = indexhtml[:-11]
@@ -239,65 +522,400 @@ def download_webfonts(indexhtml, cookies, webfonts_css, output_dir, logger=logge
         webfonts_css_str = f.read()
         font_paths = {e[5:-2] for e in re.findall(r"url\('[^')]+\.woff2'\)", webfonts_css_str)}
 
+    if cache is not None:
+        for font_path in sorted(font_paths):
+            woff2_filename = font_path.split("/")[-1]
+            if cache.get(("font", indexhtml, font_path), f"{output_dir}/{woff2_filename}"):
+                font_paths.remove(font_path)
+                logger.info(f"Use cached '{woff2_filename}'.")
+
     logger.info(f"Download the ebook's required fonts (found {len(font_paths)} font URLs).")
-    for font_path in font_paths:
-        url = f"{baseurl}/css/{font_path}"
-        reply = requests.get(url, cookies=cookies)
-        if reply.ok:
+    if session is None:
+        session = make_session(cookies, pool_size=concurrency)
+    urls = {font_path: f"{baseurl}/css/{font_path}" for font_path in font_paths}
+    for font_path, reply in fetch_concurrently(session, urls, concurrency, fetcher=fetcher):
+        url = urls[font_path]
+        if reply is not None and reply.ok:
             woff2_filename = font_path.split("/")[-1]
             with open(f"{output_dir}/{woff2_filename}", "wb") as f:
                 f.write(reply.content)
+            if cache is not None:
+                cache.put(("font", indexhtml, font_path), f"{output_dir}/{woff2_filename}")
             logger.info(f"Wrote '{woff2_filename}' to file.")
         else:
             logger.warning(f"Error downloading font from '{url}'. Skipping font.")
 
 
-def generate_pdfs(svg_dir, font_dir, output_dir, logger=logger):
-    """Generates PDFs from the ebook's individual SVG files.
+def install_fonts(font_dir, font_store=None, logger=logger):
+    """Converts the downloaded WOFF2 fonts to TTF and makes them available to
+    inkscape via a fontconfig configuration of their own.
+
+    The configuration is written next to 'font_dir' and includes only the
+    fonts in 'font_dir', such that concurrent jobs neither see each other's
+    fonts nor modify shared state.
 
     Args:
-        pages_dir (str): system path to the directory containing the downloaded
-            SVG files
         font_dir (str): system path to the directory containing the downloaded
             font files.
-        output_dir (str): system path to the PDFs' output directory. Directory
-            must exist.
+        font_store (learninghub.fonts.FontStore): store of fonts decompressed
+            by previous jobs. Stored fonts are hard linked into 'font_dir',
+            such that evicting them does not affect the job, instead of being
+            decompressed again. If 'None' is passed, all fonts are
+            decompressed.
 
     Returns:
-        None
+        dict: environment to run inkscape with
     """
 
     logger.info("Generate TTF fonts from downloaded WOFF2 fonts.")
     for woff2_filename in [f for f in os.listdir(f"{font_dir}") if f.endswith(".woff2")]:
         input_path = f"{font_dir}/{woff2_filename}"
         output_path = input_path[:-6] + ".ttf"
-        decompress(input_path, output_path)
-
-    fontconfig_dir = f"{os.getenv('HOME')}/.local/share/fonts"
-    logger.info(f"Copy TTF fonts to fontconfig directory '{fontconfig_dir}'.")
-    os.makedirs(fontconfig_dir, exist_ok=True)
-    for ttf_filename in [f for f in os.listdir(f"{font_dir}") if f.endswith(".ttf")]:
-        shutil.copy(f"{font_dir}/{ttf_filename}", fontconfig_dir, follow_symlinks=True)
-
-    logger.info("Regenerate fontconfig cache.")
-    result = subprocess.run(["fc-cache"],
+        if os.path.lexists(output_path):  # installed by a previous attempt
+            continue
+        if font_store is None:
+            from fontTools.ttLib.woff2 import decompress
+            decompress(input_path, output_path)
+        else:
+            ttf_path = font_store.ttf_path(input_path)
+            try:
+                os.link(ttf_path, output_path)
+            except OSError:  # e.g. on another file system
+                shutil.copyfile(ttf_path, output_path)
+
+    config_path = f"{os.path.dirname(os.path.abspath(font_dir))}/fonts.conf"
+    logger.info(f"Write fontconfig configuration '{config_path}'.")
+    env = write_fontconfig(font_dir, config_path)
+
+    # Build the cache once, instead of letting every inkscape process scan the fonts.
+    logger.info("Generate fontconfig cache.")
+    result = subprocess.run(["fc-cache"], env=env,
                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if result.returncode != 0:
-        logger.warning(f"Error regenerating fontconfig cache.\nstdout: {str(result.stdout, 'utf-8')}\nstderr: {str(result.stderr, 'utf-8')}")
+        logger.warning(f"Error generating fontconfig cache.\nstdout: {str(result.stdout, 'utf-8')}\nstderr: {str(result.stderr, 'utf-8')}")
+    return env
+
+
+def optimize_pages(svg_dir, image_dir, precision=3, logger=logger):
+    """Optimizes the downloaded SVG files in place for rendering (see
+    'learninghub.svgopt.optimize_svg').
+
+    Args:
+        svg_dir (str): system path to the directory containing the SVG files
+        image_dir (str): system path to a directory for the images extracted
+            from the pages. Directory must exist.
+        precision (int): decimals kept of coordinates and lengths
 
-    logger.info("Generate individual PDFs from the downloaded SVGs using inkscape.")
-    for svg_filename in os.listdir(svg_dir):
+    Returns:
+        None
+    """
+    logger.info("Optimize the pages' SVG files.")
+    bytes_in, bytes_out = 0, 0
+    for svg_filename in sorted(os.listdir(svg_dir)):
         svg_path = f"{svg_dir}/{svg_filename}"
+        try:
+            stats = optimize_svg(svg_path, svg_path, image_dir=image_dir, precision=precision)
+        except Exception as e:  # the unoptimized page is still rendered
+            logger.warning(f"Error optimizing '{svg_path}': {e}")
+            continue
+        bytes_in += stats["bytes_in"]
+        bytes_out += stats["bytes_out"]
+        logger.debug(f"Optimized '{svg_filename}': {stats}")
+    logger.info(f"Optimized the pages from {bytes_in} to {bytes_out} bytes.")
+
+
+def generate_pdfs(svg_dir, font_dir, output_dir, workers=None, batch_size=None, renderer="inkscape", logger=logger):
+    """Generates PDFs from the ebook's individual SVG files.
+
+    Args:
+        pages_dir (str): system path to the directory containing the downloaded
+            SVG files
+        font_dir (str): system path to the directory containing the downloaded
+            font files.
+        output_dir (str): system path to the PDFs' output directory. Directory
+            must exist.
+        workers (int): number of inkscape processes running in parallel.
+            Defaults to the number of CPUs.
+        batch_size (int): number of pages converted by a single long-lived
+            inkscape shell. If 'None' is passed, one inkscape process is
+            started per page.
+        renderer (str): 'inkscape' or 'cairo' (see
+            'learninghub.render.make_renderer')
+
+    Returns:
+        None
+    """
+
+    env = install_fonts(font_dir, logger=logger)
+
+    logger.info(f"Generate individual PDFs from the downloaded SVGs using {renderer} ({workers or os.cpu_count()} in parallel).")
+    pages = []
+    for svg_filename in sorted(os.listdir(svg_dir)):
         pdf_filename = svg_filename.split(".")[0] + ".pdf"
-        pdf_path = f"{output_dir}/{pdf_filename}"
-        logger.info(f"Generating a PDF from file '{svg_path}'.")
-        result = subprocess.run(["inkscape", f"--export-filename={pdf_path}", svg_path],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            logger.warning(f"Error generating a PDF from file '{svg_path}'. Skipping file.\nstdout: {str(result.stdout, 'utf-8')}\nstderr: {str(result.stderr, 'utf-8')}")
+        pages.append((f"{svg_dir}/{svg_filename}", f"{output_dir}/{pdf_filename}"))
+    for svg_path, pdf_path, error in render.render_pages(pages, workers=workers, batch_size=batch_size, env=env, renderer=renderer):
+        if error is None:
+            logger.info(f"Generated a PDF from file '{svg_path}'.")
+        else:
+            logger.warning(f"Error generating a PDF from file '{svg_path}'. Skipping file.\n{error}")
+
+
+_UNCHANGED = object()  # marks a page which is copied from the previous output
+
+
+def stream_pages_to_pdf(indexhtml, session, num_pages, svg_dir, pdf_dir, output_path, download_concurrency=1, render_workers=None, render_batch_size=None, max_in_flight=32, cache=None, env=None, metrics=None, manifest=None, fetcher=None, image_dir=None, renderer="inkscape", pages=None, revalidate=False, base_pdf=None, base_pages=None, page_records=None, logger=logger):
+    """Downloads an ebook's pages, converts them to PDF and concatenates them
+    into a single PDF, with each page moving on to the next stage as soon as
+    it is ready. Fonts must have been installed beforehand.
+
+    Intermediate SVG and PDF files are deleted once they have been consumed,
+    such that at most 'max_in_flight' pages occupy memory and disk. Pages which
+    fail to download (after retrying) or convert are skipped with a warning.
+
+    Args:
+        indexhtml (str): url of the ebook's 'index.html'
+        session (requests.Session): session carrying the ebook's cookies
+        num_pages (int): number of pages in the ebook
+        svg_dir (str): system path to a directory for the downloaded SVGs.
+            Directory must exist.
+        pdf_dir (str): system path to a directory for the per-page PDFs.
+            Directory must exist.
+        output_path (str): system path of the output file. Base directory must
+            exist.
+        download_concurrency (int): maximum number of pages downloaded in
+            parallel. The actual number adapts to the server's replies (see
+            'learninghub.fetch.FetchController').
+        render_workers (int): number of inkscape processes running in
+            parallel. Defaults to the number of CPUs.
+        render_batch_size (int): maximum number of pages converted by a single
+            inkscape shell. If 'None' is passed, one inkscape process is
+            started per page.
+        max_in_flight (int): maximum number of pages which have been
+            downloaded but not yet concatenated.
+        cache (learninghub.cache.Cache): cache to look up and store the pages'
+            SVGs and PDFs. Cached SVGs are not downloaded again, and PDFs are
+            looked up by the content hash of their SVG and the renderer's tag
+            (see 'learninghub.render.InkscapeRenderer').
+        env (dict): environment to run inkscape with, as returned by
+            'install_fonts'
+        metrics (learninghub.metrics.JobMetrics): receives per-page timings,
+            byte counts and failures
+        manifest (learninghub.manifest.Manifest): checkpoint to record the
+            concatenated pages in. Their PDFs are kept, and pages recorded by
+            a previous attempt are neither downloaded nor converted again.
+        fetcher (learninghub.fetch.FetchController): controller to issue the
+            requests through. If 'None' is passed, one is created for
+            'session'.
+        image_dir (str): if given, the downloaded SVGs are optimized before
+            rendering (see 'learninghub.svgopt.optimize_svg'), and embedded
+            images are extracted into this directory. Directory must exist.
+        renderer (str): 'inkscape' or 'cairo' (see
+            'learninghub.render.make_renderer')
+        pages (list(int)): the pages to convert, in order. Defaults to all.
+        revalidate (bool): revalidate cached pages with conditional requests
+            (ETag and Last-Modified) or, if the server does not support
+            them, by comparing the content hash, instead of using them
+            unchecked. Requires 'cache'.
+        base_pdf (str): system path of a previous output for the same
+            'pages'. If 'revalidate' is set, unchanged pages are copied from
+            it instead of being converted again.
+        base_pages (dict): maps pages to the records (see 'page_records') of
+            the SVGs 'base_pdf' was converted from. A page of 'base_pdf' is
+            only reused if the server confirms its record; pages without a
+            record are converted again.
+        page_records (dict): if given, receives per merged page a record of
+            the SVG it was converted from: the SVG's content hash under
+            "digest" and the server's validators under "etag" and
+            "last_modified". Pages resumed from a checkpoint or taken from
+            the cache without revalidation have no record.
+
+    Returns:
+        int: number of skipped pages
+    """
+    render_workers = render_workers or os.cpu_count() or 1
+    if pages is None:
+        pages = list(range(1, num_pages+1))
+    revalidate = revalidate and cache is not None
+    base_pages = base_pages or {}
+    if page_records is None:
+        page_records = {}
+    fetched = {}  # page -> record of the downloaded or revalidated SVG, until merged
+    base_reader, base_index = None, {}
+    if revalidate and base_pdf is not None:
+        from PyPDF2 import PdfFileReader
+        base_reader = PdfFileReader(base_pdf, strict=False)
+        if base_reader.getNumPages() == len(pages):
+            base_index = {page: index for index, page in enumerate(pages)}
+        else:
+            logger.warning(f"The previous output has {base_reader.getNumPages()} instead of {len(pages)} pages. Convert all pages.")
+    if metrics is None:
+        metrics = JobMetrics()
+    if fetcher is None:
+        fetcher = FetchController(session, max_concurrency=download_concurrency, metrics=metrics)
+    logger.info(f"Stream the ebook's pages through download (up to {download_concurrency} in parallel), conversion using {renderer} ({render_workers} in parallel) and concatenation.")
+    baseurl = indexhtml[:-11]
+    checkpointed = set()
+    if manifest is not None:
+        checkpointed = {page for page in manifest.pages if os.path.isfile(f"{pdf_dir}/{page_filename(page, num_pages, 'pdf')}")}
+        if checkpointed:
+            logger.info(f"Resume with {len(checkpointed)} pages converted previously.")
+
+    def optimize(page, svg_path):
+        start = time.monotonic()
+        try:
+            stats = optimize_svg(svg_path, svg_path, image_dir=image_dir)
+        except Exception as e:  # the unoptimized page is still rendered
+            logger.warning(f"Error optimizing page {page}: {e}")
+            return svg_path
+        metrics.observe_page("optimize", time.monotonic() - start)
+        metrics.inc("learninghub_svg_saved_bytes_total", stats["bytes_in"] - stats["bytes_out"])
+        logger.debug(f"Optimized page {page}: {stats}")
+        return svg_path
+
+    def download(page):
+        if page in checkpointed:
+            return None
+        key = ("svg", indexhtml, page)
+        svg_path = f"{svg_dir}/{page_filename(page, num_pages, 'svg')}"
+        if not revalidate and cache is not None and cache.get(key, svg_path):
+            metrics.inc("learninghub_cache_hits_total", kind="svg")
+            return svg_path if image_dir is None else optimize(page, svg_path)
+        url = f"{baseurl}/xml/topic{page}.svg"
+        # Pages of the previous output are revalidated against the SVGs they
+        # were converted from, since the shared SVG cache may have been
+        # refreshed by another conversion in the meantime.
+        base = base_pages.get(page) if page in base_index else None
+        if base is not None:
+            cached_digest, validators = base.get("digest"), base
+        elif revalidate:
+            cached_digest, validators = cache.digest(key), cache.meta(key) or {}
+        else:
+            cached_digest, validators = None, {}
+        headers = {}
+        if cached_digest is not None:
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last_modified" in validators:
+                headers["If-Modified-Since"] = validators["last_modified"]
+        start = time.monotonic()
+        reply = fetcher.get(url, headers=headers)
+        unchanged = reply.status_code == 304 or (
+            # the server ignores the validators, compare the content instead
+            reply.ok and cached_digest is not None and hashlib.sha256(reply.content).hexdigest() == cached_digest)
+        if unchanged:
+            metrics.inc("learninghub_cache_hits_total", kind="svg_revalidated")
+            if base is not None:
+                fetched[page] = base
+                return _UNCHANGED
+            if cache.get(key, svg_path):
+                fetched[page] = dict(validators, digest=cached_digest)
+                return svg_path if image_dir is None else optimize(page, svg_path)
+            reply = fetcher.get(url)  # evicted concurrently
+        if not reply.ok:
+            raise PageError(f"Error downloading ebook page {page} from '{url}' (HTTP {reply.status_code}).")
+        metrics.observe_page("download", time.monotonic() - start)
+        metrics.inc("learninghub_bytes_total", len(reply.content), kind="svg")
+        with open(svg_path, "wb") as f:  # as received, such that the file's digest is the content's
+            f.write(reply.content)
+        validators = {"etag": reply.headers.get("ETag"), "last_modified": reply.headers.get("Last-Modified")}
+        validators = {k: v for k, v in validators.items() if v}
+        fetched[page] = dict(validators, digest=hashlib.sha256(reply.content).hexdigest())
+        if cache is not None:
+            cache.put(key, svg_path, meta=validators)
+        return svg_path if image_dir is None else optimize(page, svg_path)
+
+    def convert(batch):
+        results = {}
+        to_render = []
+        svg_digests = {}
+        for page, svg_path in batch:
+            pdf_path = f"{pdf_dir}/{page_filename(page, num_pages, 'pdf')}"
+            if page in checkpointed:
+                results[page] = pdf_path
+                continue
+            if svg_path is _UNCHANGED:
+                results[page] = _UNCHANGED
+                continue
+            if cache is not None:
+                svg_digests[svg_path] = file_digest(svg_path)
+                if cache.get(("pdf", svg_digests[svg_path], backend.tag), pdf_path):
+                    metrics.inc("learninghub_cache_hits_total", kind="pdf")
+                    results[page] = pdf_path
+                    continue
+            to_render.append((page, svg_path, pdf_path))
+
+        errors = {}
+        start = time.monotonic()
+        if to_render:
+            errors = backend.render([(svg_path, pdf_path) for _, svg_path, pdf_path in to_render])
+        for _ in to_render:  # a batch's pages are rendered by a single process
+            metrics.observe_page("convert", (time.monotonic() - start) / len(to_render))
+        for page, svg_path, pdf_path in to_render:
+            if svg_path in errors:
+                results[page] = PageError(f"Error generating a PDF from file '{svg_path}'.\n{errors[svg_path]}")
+            else:
+                results[page] = pdf_path
+                if cache is not None:
+                    cache.put(("pdf", svg_digests[svg_path], backend.tag), pdf_path)
+
+        for _, svg_path in batch:
+            if svg_path is not None and svg_path is not _UNCHANGED:
+                os.remove(svg_path)
+        return list(results.items())
+
+    num_unchanged = 0
+    num_merged = 0
+
+    def merge(page, pdf_path):
+        nonlocal num_unchanged, num_merged
+        if page in fetched:
+            page_records[page] = fetched.pop(page)
+        start = time.monotonic()
+        if pdf_path is _UNCHANGED:
+            writer.append_page(base_reader, base_index[page])
+        else:
+            writer.append(pdf_path)
+        metrics.observe_page("merge", time.monotonic() - start)
+        if pdf_path is _UNCHANGED:
+            num_unchanged += 1
+        elif manifest is None:
+            os.remove(pdf_path)
+        elif page not in checkpointed:
+            manifest.complete_page(page)
+        num_merged += 1
+        logger.info(f"Converted page {page} ({num_merged}/{len(pages)}).")
+
+    num_skipped = 0
+
+    def skip(page, stage, error):
+        nonlocal num_skipped
+        num_skipped += 1
+        metrics.inc("learninghub_page_failures_total", stage=stage)
+        logger.warning(f"Skipping page {page} ({stage} failed): {error}")
+
+    from learninghub.merge import IncrementalPdfWriter
+    backend = render.make_renderer(renderer, env=env, workers=render_workers)
+    try:
+        with IncrementalPdfWriter(output_path) as writer:
+            run_pipeline(pages, download, convert, merge, skip,
+                         download_concurrency=download_concurrency, convert_workers=render_workers,
+                         convert_batch_size=render_batch_size or 1, max_in_flight=max_in_flight)
+    finally:
+        backend.close()
+
+    logger.info(f"Downloaded with up to {fetcher.peak_limit} parallel requests, {fetcher.num_retries} requests were retried.")
+    if base_index:
+        logger.info(f"Kept {num_unchanged} unchanged pages of the previous output, converted {len(pages) - num_unchanged - num_skipped} changed pages.")
+    if image_dir is not None:
+        saved = metrics.summary()["counters"].get("learninghub_svg_saved_bytes_total", 0)
+        logger.info(f"Optimizing the SVGs saved {saved} bytes.")
+    logger.info(f"Shared {writer.num_deduplicated} duplicate objects (e.g. fonts and images) between pages.")
+    metrics.inc("learninghub_bytes_total", os.path.getsize(output_path), kind="pdf")
+    logger.info(f"Done: '{output_path}'")
+    return num_skipped
 
 
-def concatenate_pdfs(pdf_dir, output_path, logger=logger):
+def concatenate_pdfs(pdf_dir, output_path, incremental=True, logger=logger):
     """Concatenates individual PDF pages into a single PDF.
 
     Args:
@@ -305,6 +923,10 @@ def concatenate_pdfs(pdf_dir, output_path, logger=logger):
             PDF pages. Its files will be concatenated in lexicographical order.
         output_path (str): system path of the output file. Base directory must
             exist.
+        incremental (bool): write each page as soon as it is read and share
+            duplicate objects between pages (see
+            'learninghub.merge.IncrementalPdfWriter'). Otherwise, all pages
+            are read before PyPDF2's merger writes the output.
 
     Returns:
         None
@@ -313,6 +935,15 @@ def concatenate_pdfs(pdf_dir, output_path, logger=logger):
     logger.info("Concatenate PDFs into a single document.")
     pdf_filenames = sorted(os.listdir(pdf_dir))
     pdf_paths = [f"{pdf_dir}/{pdf_filename}" for pdf_filename in pdf_filenames]
+    if incremental:
+        from learninghub.merge import IncrementalPdfWriter
+        with IncrementalPdfWriter(output_path) as writer:
+            for pdf_path in pdf_paths:
+                writer.append(pdf_path)
+        logger.info(f"Done: '{output_path}'")
+        return
+
+    from PyPDF2 import PdfFileMerger, PdfFileReader
     pdf = PdfFileMerger()
     for pdf_path in pdf_paths:
         pdf.append(PdfFileReader(pdf_path, 'rb'))
@@ -0,0 +1,225 @@
+import os
+import signal
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Seconds a login waits for each page load and element of the learninghub.
+LOGIN_WAIT_SECONDS = 90
+# Upper bound of a login's duration: three page loads and six element waits
+# (see 'learninghub._login_and_export'), plus the simulated input delays.
+LOGIN_TIMEOUT_SECONDS = 9 * LOGIN_WAIT_SECONDS + 60
+# Origins a login visits, whose storage is cleared after each login.
+LOGIN_ORIGINS = ("https://learninghub.sap.com", "https://accounts.sap.com", "https://saplearninghub.plateau.com")
+
+
+def launch_browser(large_window=True):
+    """Starts a headless Chromium controlled by webdriver.
+
+    Args:
+        large_window (bool): use a large window size, such that screenshots
+            capture all relevant content.
+    """
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    browser_options = Options()
+    browser_options.add_argument("--headless")
+    browser_options.add_argument("--no-sandbox")  # Required to run inside docker
+    browser_options.add_argument("--disable-gpu")  # Required to run inside docker
+    browser_options.add_argument("--disable-dev-shm-usage")  # Alternatively to this flag, map /dev/shm into the container.
+    if large_window:
+        browser_options.add_argument("window-size=2048x4096")  # Set a large window size for snapshots to capture all relevant content.
+    return webdriver.Chrome(options=browser_options)
+
+
+def _process_tree(pid):
+    """Returns the pids of a process and all its descendants. Relies on
+    Linux's procfs; returns only 'pid' elsewhere."""
+    pids = [pid]
+    for p in pids:
+        try:
+            for tid in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{tid}/children") as f:
+                    pids.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def _rss_bytes(pids):
+    """Returns the summed resident set size of the processes, as reported by
+    procfs. Processes which cannot be inspected are ignored."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class _PooledBrowser():
+    def __init__(self, driver):
+        self.driver = driver
+        self.uses = 0
+        self.pid = driver.service.process.pid  # chromedriver, parent of the browser processes
+
+    def rss_bytes(self):
+        return _rss_bytes(_process_tree(self.pid))
+
+    def reset(self):
+        """Clears all state a login leaves behind. The storage is cleared for
+        'LOGIN_ORIGINS' and the origins of all cookies, which include the
+        ebook's."""
+        cookies = self.driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+        origins = set(LOGIN_ORIGINS) | {f"https://{cookie['domain'].lstrip('.')}" for cookie in cookies}
+        for origin in sorted(origins):
+            self.driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        self.driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        self.driver.execute_cdp_cmd("Network.clearBrowserCache", {})
+        self.driver.get("about:blank")
+
+    def kill(self):
+        """Kills the browser's processes. Used if the browser hangs, in which
+        case webdriver would not respond."""
+        for pid in reversed(_process_tree(self.pid)):  # children first
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def quit(self):
+        """Terminates the browser, killing processes which survive."""
+        pids = _process_tree(self.pid)
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+        for pid in reversed(pids):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class BrowserPool():
+    """Pool of warm headless browsers used for logins.
+
+    At most 'size' browsers exist at any time, which bounds the number of
+    concurrent logins and the browsers' memory usage. A browser is reset after
+    each login and replaced by a fresh one after 'max_uses' logins, if its
+    processes' resident memory exceeds 'max_rss_bytes', or if the login
+    failed. Browsers checked out for longer than 'checkout_timeout' seconds,
+    by default longer than a login may take, are killed, which makes the
+    pending webdriver calls fail.
+
+    Instances may be shared between threads.
+    """
+    def __init__(self, size=2, max_uses=20, max_rss_bytes=None, checkout_timeout=LOGIN_TIMEOUT_SECONDS, launch=launch_browser):
+        self.size = size
+        self.max_uses = max_uses
+        self.max_rss_bytes = max_rss_bytes
+        self.checkout_timeout = checkout_timeout
+        self.launch = launch
+        self._idle = []
+        self._count = 0  # number of idle, checked out and launching browsers
+        self._cond = threading.Condition()
+
+    def _launch(self):
+        try:
+            return _PooledBrowser(self.launch())
+        except BaseException:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def warm(self):
+        """Launches browsers in a background thread until the pool holds
+        'size' browsers."""
+        def fill():
+            while True:
+                with self._cond:
+                    if self._count >= self.size:
+                        return
+                    self._count += 1
+                try:
+                    browser = self._launch()
+                except Exception as e:
+                    logger.warning(f"Error launching a browser: {e}")
+                    return
+                with self._cond:
+                    self._idle.append(browser)
+                    self._cond.notify()
+        threading.Thread(target=fill, daemon=True).start()
+
+    @contextmanager
+    def browser(self):
+        """Checks out a browser for the duration of the context. Blocks while
+        all browsers are checked out.
+
+        Yields:
+            selenium.webdriver.Chrome
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._idle or self._count < self.size)
+            if self._idle:
+                browser = self._idle.pop()
+            else:
+                browser = None
+                self._count += 1
+        if browser is None:
+            browser = self._launch()
+
+        browser.uses += 1
+        watchdog = threading.Timer(self.checkout_timeout, browser.kill)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            yield browser.driver
+        except BaseException:
+            self._discard(browser)
+            raise
+        else:
+            self._checkin(browser)  # a reset which hangs is caught by the watchdog, too
+        finally:
+            watchdog.cancel()
+
+    def _discard(self, browser):
+        browser.quit()
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+        self.warm()  # replace the browser in the background
+
+    def _checkin(self, browser):
+        if browser.uses >= self.max_uses:
+            logger.debug("Recycle browser after reaching its maximum number of uses.")
+            self._discard(browser)
+            return
+        if self.max_rss_bytes and browser.rss_bytes() > self.max_rss_bytes:
+            logger.debug("Recycle browser after exceeding the memory limit.")
+            self._discard(browser)
+            return
+        try:
+            browser.reset()
+        except Exception:
+            self._discard(browser)
+            return
+        with self._cond:
+            self._idle.append(browser)
+            self._cond.notify()
+
+    def close(self):
+        """Terminates all idle browsers."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+        for browser in idle:
+            browser.quit()
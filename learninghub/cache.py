@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def file_digest(path):
+    """Returns the hex-encoded SHA-256 digest of a file's content."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Cache():
+    """Persistent on-disk cache shared by all conversion jobs.
+
+    Files are stored once per content hash (SHA-256) below 'objects/'. An
+    sqlite index maps keys, i.e. tuples such as ("svg", indexhtml, page), to
+    content hashes and keeps track of the blobs' sizes and last access times.
+    Whenever the total size exceeds the quota, the least recently used blobs
+    are evicted together with all keys referring to them. Each key may carry
+    a small JSON-serializable dict of metadata, e.g. HTTP validators.
+
+    Instances may be shared between threads, and several processes may use
+    the same cache directory. Blobs are written to temporary files and then
+    renamed into place, so a blob's path either does not exist or holds
+    its complete content.
+    """
+    def __init__(self, cache_dir, quota_bytes):
+        self.cache_dir = cache_dir
+        self.quota_bytes = quota_bytes
+        os.makedirs(f"{cache_dir}/objects", exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            if "meta" not in [row[1] for row in db.execute("PRAGMA table_info(entries)")]:
+                db.execute("ALTER TABLE entries ADD COLUMN meta TEXT")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(f"{self.cache_dir}/index.db", timeout=30)
+        try:
+            with db:  # commits or rolls back
+                yield db
+        finally:
+            db.close()
+
+    def _blob_path(self, digest):
+        return f"{self.cache_dir}/objects/{digest[:2]}/{digest}"
+
+    @staticmethod
+    def _key(key):
+        return "\0".join(str(part) for part in key)
+
+    def digest(self, key):
+        """Returns the content hash stored for 'key', or 'None' if the key is
+        not cached. Marks the blob as recently used."""
+        with self._connect() as db:
+            row = db.execute("SELECT digest FROM entries WHERE key = ?", (self._key(key),)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE blobs SET last_access = ? WHERE digest = ?", (time.time(), row[0]))
+        if not os.path.isfile(self._blob_path(row[0])):
+            return None
+        return row[0]
+
+    def meta(self, key):
+        """Returns the metadata stored with 'key', or 'None' if the key is not
+        cached or carries no metadata."""
+        with self._connect() as db:
+            row = db.execute("SELECT meta FROM entries WHERE key = ?", (self._key(key),)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def get(self, key, output_path):
+        """Copies the file cached for 'key' to 'output_path'.
+
+        Returns:
+            bool: whether the key was cached
+        """
+        digest = self.digest(key)
+        if digest is None:
+            return False
+        try:
+            shutil.copyfile(self._blob_path(digest), output_path)
+        except FileNotFoundError:  # evicted concurrently
+            return False
+        return True
+
+    def put(self, key, input_path, meta=None):
+        """Stores a copy of the file at 'input_path' under 'key' and evicts
+        old blobs if the quota is exceeded. 'meta' is stored with the key.
+
+        Returns:
+            str: the file's content hash
+        """
+        digest = file_digest(input_path)
+        blob_path = self._blob_path(digest)
+        if not os.path.isfile(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path))
+            os.close(fd)
+            shutil.copyfile(input_path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO blobs (digest, size, last_access) VALUES (?, ?, ?)",
+                       (digest, os.path.getsize(blob_path), time.time()))
+            db.execute("INSERT OR REPLACE INTO entries (key, digest, meta) VALUES (?, ?, ?)",
+                       (self._key(key), digest, json.dumps(meta) if meta is not None else None))
+        self.evict()
+        return digest
+
+    def evict(self):
+        """Removes the least recently used blobs until the cache's total size
+        is within its quota."""
+        with self._connect() as db:
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.quota_bytes:
+                return
+            for digest, size in db.execute("SELECT digest, size FROM blobs ORDER BY last_access").fetchall():
+                if total <= self.quota_bytes:
+                    break
+                db.execute("DELETE FROM entries WHERE digest = ?", (digest,))
+                db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                try:
+                    os.remove(self._blob_path(digest))
+                except FileNotFoundError:
+                    pass
+                total -= size
+                logger.debug(f"Evicted '{digest}' ({size} bytes) from the cache.")
@@ -0,0 +1,163 @@
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Status codes which indicate a transient condition on the server's side.
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(reply):
+    """Returns the delay requested by a reply's 'Retry-After' header in
+    seconds, or 'None' if there is no valid header."""
+    value = reply.headers.get("Retry-After") if reply is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class FetchController():
+    """Issues GET requests on a shared session while adapting the number of
+    parallel requests to what the server sustains.
+
+    Transient failures (connection errors and the status codes in
+    'RETRY_STATUS') are retried with exponential backoff and full jitter, or
+    after the delay requested by a 'Retry-After' header, during which no other
+    request is started either.
+
+    The concurrency limit follows AIMD: it grows by one after a limit's worth
+    of requests succeeded, and is halved on a transient failure or when the
+    latency exceeds 'latency_tolerance' times the lowest latency seen. It
+    never exceeds 'max_concurrency', such that callers may use that many
+    threads. Instances may be shared between threads.
+    """
+    def __init__(self, session, max_concurrency=1, initial_concurrency=None, max_retries=5, backoff_base=0.5, backoff_max=30.0, latency_tolerance=3.0, metrics=None):
+        """
+        Args:
+            session (requests.Session): session used for all requests
+            max_concurrency (int): upper bound of the concurrency limit
+            initial_concurrency (int): concurrency limit to start with.
+                Defaults to half of 'max_concurrency'.
+            max_retries (int): number of retries of a request before its last
+                reply (or error) is passed to the caller
+            backoff_base (float): backoff before the first retry in seconds
+            backoff_max (float): upper bound of the backoff in seconds
+            latency_tolerance (float): factor over the lowest latency seen at
+                which the concurrency limit is decreased
+            metrics (learninghub.metrics.JobMetrics): receives the retries
+        """
+        self.session = session
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.limit = float(min(self.max_concurrency, initial_concurrency or max(1, self.max_concurrency // 2)))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latency_tolerance = latency_tolerance
+        self.metrics = metrics
+        self.num_retries = 0
+        self.peak_limit = int(self.limit)
+        self._in_flight = 0
+        self._min_latency = None
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                elif self._in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    self._in_flight += 1
+                    return
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _increase(self, latency):
+        with self._cond:
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            if latency > self._min_latency * self.latency_tolerance:
+                self._decrease_locked("latency")
+                return
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.peak_limit = max(self.peak_limit, int(self.limit))
+            self._cond.notify_all()
+
+    def _decrease_locked(self, reason):
+        # Requests in flight when the limit was decreased already saw the old
+        # limit, hence decrease at most once per round trip.
+        now = time.monotonic()
+        if now - self._last_decrease < (self._min_latency or 0.0):
+            return
+        self._last_decrease = now
+        limit = max(1.0, self.limit / 2)
+        if int(limit) < int(self.limit):
+            logger.debug(f"Decrease the number of parallel requests to {int(limit)} ({reason}).")
+        self.limit = limit
+
+    def _backoff(self, attempt, reply):
+        delay = retry_after_seconds(reply)
+        with self._cond:
+            self._decrease_locked("retry")
+            if delay is not None:
+                # The server asked all clients to wait, not just this request.
+                self._paused_until = max(self._paused_until, time.monotonic() + min(delay, self.backoff_max))
+                return
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def get(self, url, **kwargs):
+        """Requests a url, retrying transient failures.
+
+        Returns:
+            requests.Response: the first reply which is not transient, or the
+                last reply once the retries are exhausted
+
+        Raises:
+            requests.RequestException: if the last attempt failed on the
+                connection level
+        """
+        import requests
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            start = time.monotonic()
+            reply, error = None, None
+            try:
+                reply = self.session.get(url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            finally:
+                self._release()
+            latency = time.monotonic() - start
+            if error is None and reply.status_code not in RETRY_STATUS:
+                self._increase(latency)
+                return reply
+            if attempt == self.max_retries:
+                break
+            reason = type(error).__name__ if error is not None else reply.status_code
+            logger.debug(f"Retry '{url}' ({reason}).")
+            with self._cond:
+                self.num_retries += 1
+            if self.metrics is not None:
+                self.metrics.inc("learninghub_fetch_retries_total")
+            self._backoff(attempt, reply)
+        if error is not None:
+            raise error
+        return reply
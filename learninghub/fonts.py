@@ -0,0 +1,85 @@
+import os
+import logging
+import tempfile
+from xml.sax.saxutils import escape
+
+from learninghub.cache import file_digest
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class FontStore():
+    """Persistent store of TTF fonts decompressed from WOFF2, keyed by the
+    WOFF2 file's content hash, such that each font is decompressed only once
+    across all jobs. May be shared between threads and processes: fonts are
+    decompressed into temporary files which are renamed once complete.
+
+    A font's modification time records its last use. Whenever the fonts'
+    total size exceeds the quota, the least recently used fonts are evicted.
+    """
+    def __init__(self, store_dir, quota_bytes=None):
+        self.store_dir = store_dir
+        self.quota_bytes = quota_bytes
+        os.makedirs(store_dir, exist_ok=True)
+
+    def ttf_path(self, woff2_path):
+        """Returns the path of the TTF font decompressed from a WOFF2 file,
+        decompressing it if it is not stored yet. Marks the font as recently
+        used."""
+        ttf_path = f"{self.store_dir}/{file_digest(woff2_path)}.ttf"
+        try:
+            os.utime(ttf_path)
+        except FileNotFoundError:
+            fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, suffix=".tmp")
+            os.close(fd)
+            from fontTools.ttLib.woff2 import decompress
+            decompress(woff2_path, tmp_path)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, ttf_path)
+            self.evict()
+        return ttf_path
+
+    def evict(self):
+        """Removes the least recently used fonts until the store's total size
+        is within its quota."""
+        if self.quota_bytes is None:
+            return
+        fonts = []
+        for entry in os.scandir(self.store_dir):
+            if entry.name.endswith(".ttf"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # evicted concurrently
+                    continue
+                fonts.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in fonts)
+        for _, size, path in sorted(fonts):
+            if total <= self.quota_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug(f"Evicted '{path}' ({size} bytes) from the font store.")
+
+
+def write_fontconfig(font_dir, config_path):
+    """Writes a fontconfig configuration which makes the fonts in 'font_dir',
+    and no other fonts, available. The font cache is kept next to the
+    configuration.
+
+    Returns:
+        dict: environment to run fontconfig clients such as inkscape with
+    """
+    cache_dir = f"{os.path.dirname(os.path.abspath(config_path))}/fontconfig-cache"
+    with open(config_path, "w") as f:
+        f.write(f"""<?xml version="1.0"?>
+<!DOCTYPE fontconfig SYSTEM "fonts.dtd">
+<fontconfig>
+  <dir>{escape(os.path.abspath(font_dir))}</dir>
+  <cachedir>{escape(cache_dir)}</cachedir>
+</fontconfig>
+""")
+    return {**os.environ, "FONTCONFIG_FILE": os.path.abspath(config_path)}
@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Manifest():
+    """Checkpoint of a conversion's progress, kept as a JSON file inside the
+    conversion's temporary directory.
+
+    Records which stages and which pages have been completed, such that a
+    conversion which was interrupted can be resumed in the same temporary
+    directory, redoing only the missing work. The file is replaced atomically
+    on every update, hence it is consistent even after a crash.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self._data = json.load(f)
+        except (OSError, ValueError):
+            self._data = {"indexhtml": None, "num_pages": None, "page_range": None, "stages": [], "pages": []}
+        self._pages = set(self._data["pages"])
+
+    def _save(self):
+        self._data["pages"] = sorted(self._pages)
+        self._data["updated"] = time.time()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._data, f)
+        os.replace(tmp_path, self.path)
+
+    def begin(self, indexhtml, num_pages, page_range=None):
+        """Declares the conversion the checkpoint belongs to. Progress recorded
+        for a different ebook, page count or range of pages is discarded."""
+        page_range = list(page_range) if page_range is not None else None
+        with self._lock:
+            if (self._data["indexhtml"], self._data["num_pages"], self._data.get("page_range")) != (indexhtml, num_pages, page_range):
+                self._data.update(indexhtml=indexhtml, num_pages=num_pages, page_range=page_range, stages=[])
+                self._pages = set()
+            self._save()
+
+    def is_done(self, indexhtml, page_range=None):
+        """Returns whether the conversion of the given ebook and range of pages
+        has been completed."""
+        page_range = list(page_range) if page_range is not None else None
+        with self._lock:
+            return ("done" in self._data["stages"] and self._data["indexhtml"] == indexhtml
+                    and self._data.get("page_range") == page_range)
+
+    @property
+    def pages(self):
+        """Set of completed pages."""
+        with self._lock:
+            return set(self._pages)
+
+    def has_stage(self, stage):
+        with self._lock:
+            return stage in self._data["stages"]
+
+    def complete_stage(self, stage):
+        with self._lock:
+            if stage not in self._data["stages"]:
+                self._data["stages"].append(stage)
+            self._save()
+
+    def complete_page(self, page):
+        with self._lock:
+            self._pages.add(page)
+            self._save()
@@ -0,0 +1,162 @@
+import weakref
+import hashlib
+import logging
+from io import BytesIO
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject,
+                            NameObject, NumberObject, StreamObject)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+_PAGES_ID = 1  # object number of the page tree's root
+_CATALOG_ID = 2  # object number of the document catalog
+
+
+class IncrementalPdfWriter():
+    """Concatenates PDFs page by page, writing every object to the output file
+    as soon as its page is appended.
+
+    Unlike PyPDF2's PdfFileMerger, which keeps every input document until the
+    final 'write', only the output's cross-reference offsets and a hash per
+    written object are kept in memory. Indirect objects whose serialization
+    is identical to an already written object, such as fonts and images
+    repeated on every page, are written only once and shared between pages.
+
+    Pages must be appended in their final order. 'close' must be called to
+    complete the file; alternatively, use the writer as a context manager.
+    """
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.num_deduplicated = 0  # number of objects shared instead of written
+        self._file = open(output_path, "wb")
+        self._file.write(b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n")
+        self._offsets = {}  # object number -> byte offset
+        self._next_id = _CATALOG_ID + 1
+        self._kids = ArrayObject()
+        self._by_digest = {}  # hash of serialized object -> IndirectObject
+        self._copied = {}  # (idnum, generation) in the current input -> IndirectObject
+        self._copied_by_reader = weakref.WeakKeyDictionary()  # see 'append_page'
+        self._in_progress = {}  # objects currently being copied; used to break cycles
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def _new_ref(self):
+        ref = IndirectObject(self._next_id, 0, self)
+        self._next_id += 1
+        return ref
+
+    def _write_object(self, ref, data):
+        self._offsets[ref.idnum] = self._file.tell()
+        self._file.write(b"%d 0 obj\n" % ref.idnum)
+        self._file.write(data)
+        self._file.write(b"\nendobj\n")
+
+    @staticmethod
+    def _serialize(obj):
+        stream = BytesIO()
+        obj.writeToStream(stream, None)
+        return stream.getvalue()
+
+    def _copy(self, obj):
+        """Returns a copy of an object of the current input whose indirect
+        references point to objects of the output, writing the referenced
+        objects on the way."""
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key in self._copied:
+                return self._copied[key]
+            if key in self._in_progress:
+                # Reference cycle: the object gets its number before it is
+                # complete, which rules out sharing it.
+                if self._in_progress[key] is None:
+                    self._in_progress[key] = self._new_ref()
+                return self._in_progress[key]
+            self._in_progress[key] = None
+            data = self._serialize(self._copy(obj.getObject()))
+            ref = self._in_progress.pop(key)
+            if ref is None:
+                digest = hashlib.sha256(data).digest()
+                ref = self._by_digest.get(digest)
+                if ref is not None:
+                    self.num_deduplicated += 1
+                else:
+                    ref = self._new_ref()
+                    self._write_object(ref, data)
+                    self._by_digest[digest] = ref
+            else:
+                self._write_object(ref, data)
+            self._copied[key] = ref
+            return ref
+        if isinstance(obj, StreamObject):
+            copy = obj.__class__()
+            copy._data = obj._data
+            copy.update({k: self._copy(v) for k, v in obj.items()})
+            return copy
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({k: self._copy(v) for k, v in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy(v) for v in obj)
+        return obj
+
+    def _append_page(self, page):
+        page_ref = page.indirectRef
+        page = {k: v for k, v in page.items() if k != "/Parent"}  # inherited attributes are copied into the page
+        ref = self._new_ref()
+        self._copied[(page_ref.idnum, page_ref.generation)] = ref  # e.g. for annotations referring to their page
+        copy = DictionaryObject({k: self._copy(v) for k, v in page.items()})
+        copy[NameObject("/Parent")] = IndirectObject(_PAGES_ID, 0, self)
+        self._write_object(ref, self._serialize(copy))
+        self._kids.append(ref)
+
+    def append(self, pdf_path):
+        """Appends all pages of a PDF file."""
+        reader = PdfFileReader(pdf_path, strict=False)
+        for page in reader.pages:
+            self._append_page(page)
+        self._copied = {}  # object numbers are only meaningful within one input
+
+    def append_page(self, reader, index):
+        """Appends a single page of an open PDF, e.g. to take unchanged pages
+        from a previous version of the output. Objects already copied from
+        the same reader are not copied again."""
+        self._copied = self._copied_by_reader.setdefault(reader, {})
+        try:
+            self._append_page(reader.getPage(index))
+        finally:
+            self._copied = {}
+
+    def close(self):
+        """Writes the page tree, the cross-reference table and the trailer."""
+        pages = DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): self._kids,
+            NameObject("/Count"): NumberObject(len(self._kids)),
+        })
+        catalog = DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(_PAGES_ID, 0, self),
+        })
+        self._write_object(IndirectObject(_PAGES_ID, 0, self), self._serialize(pages))
+        self._write_object(IndirectObject(_CATALOG_ID, 0, self), self._serialize(catalog))
+
+        xref_offset = self._file.tell()
+        self._file.write(b"xref\n0 %d\n" % self._next_id)
+        self._file.write(b"%010d %05d f \n" % (0, 65535))
+        for idnum in range(1, self._next_id):
+            self._file.write(b"%010d %05d n \n" % (self._offsets[idnum], 0))
+        trailer = DictionaryObject({
+            NameObject("/Size"): NumberObject(self._next_id),
+            NameObject("/Root"): IndirectObject(_CATALOG_ID, 0, self),
+        })
+        self._file.write(b"trailer\n" + self._serialize(trailer))
+        self._file.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+        self._file.close()
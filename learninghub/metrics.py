@@ -0,0 +1,135 @@
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Upper bounds of the latency histograms' buckets in seconds.
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class Registry():
+    """Aggregates counters and latency histograms over all conversions and
+    renders them in the Prometheus text exposition format. Instances may be
+    shared between threads."""
+    def __init__(self):
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            ii = bisect.bisect_left(BUCKETS, value)
+            if ii < len(BUCKETS):
+                histogram[0][ii] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels, **extra):
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        described = set()
+        for (name, labels), value in counters:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS, buckets):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, le='+Inf')} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REGISTRY.describe("learninghub_jobs_total", "Conversions by outcome.")
+REGISTRY.describe("learninghub_stage_seconds", "Duration of a conversion's stages.")
+REGISTRY.describe("learninghub_page_seconds", "Time spent on a single page per stage.")
+REGISTRY.describe("learninghub_bytes_total", "Bytes downloaded and written by kind.")
+REGISTRY.describe("learninghub_startup_seconds", "Time until the server is ready and spent warming up, by step.")
+REGISTRY.describe("learninghub_page_failures_total", "Pages skipped by the stage which failed.")
+REGISTRY.describe("learninghub_fetch_retries_total", "Requests which were retried.")
+REGISTRY.describe("learninghub_cache_hits_total", "Cache lookups which hit, by kind.")
+REGISTRY.describe("learninghub_svg_saved_bytes_total", "Bytes removed from the pages' SVGs by the optimization.")
+
+
+class JobMetrics():
+    """Collects the timings and counters of a single conversion and forwards
+    them to a registry for aggregation. Instances may be shared between the
+    threads of a conversion."""
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self.stages = {}  # stage -> seconds
+        self.pages = {}  # stage -> [count, total seconds, max seconds]
+        self.counters = {}  # (name, labels) -> value
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Measures the duration of the context as stage 'name'."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+            self.registry.observe("learninghub_stage_seconds", seconds, stage=name)
+
+    def observe_page(self, stage, seconds):
+        with self._lock:
+            count, total, maximum = self.pages.get(stage, (0, 0.0, 0.0))
+            self.pages[stage] = (count + 1, total + seconds, max(maximum, seconds))
+        self.registry.observe("learninghub_page_seconds", seconds, stage=stage)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.registry.inc(name, value, **labels)
+
+    def summary(self):
+        """Returns the job's metrics as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "stage_seconds": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+                "page_seconds": {
+                    stage: {"count": count, "mean": round(total / count, 3), "max": round(maximum, 3)}
+                    for stage, (count, total, maximum) in self.pages.items()
+                },
+                "counters": {
+                    name + Registry._labels(labels): value for (name, labels), value in self.counters.items()
+                },
+            }
@@ -0,0 +1,124 @@
+import queue
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class PageError(Exception):
+    """Raised by a pipeline stage to skip a single page."""
+
+
+_DONE = object()  # sentinel which stops a conversion worker
+
+
+def run_pipeline(pages, download, convert, merge, skip, download_concurrency=1, convert_workers=1, convert_batch_size=1, max_in_flight=32):
+    """Streams an ebook's pages through the download, convert and merge
+    stages, such that network, CPU and the merge overlap.
+
+    Pages are downloaded in the given order by a pool of threads and handed
+    to the conversion workers as soon as they arrive. A conversion worker
+    takes whatever pages are ready, up to 'convert_batch_size' at once. The
+    converted pages are merged in order by the calling thread. At most
+    'max_in_flight' pages are downloaded but not yet merged at any time, which
+    bounds memory and temporary disk usage. As the lowest unmerged page is
+    always in flight, the pipeline cannot stall on this limit.
+
+    The stage callables may raise 'PageError' (or any other exception) to
+    skip a page. 'merge' and 'skip' are only ever called by the calling
+    thread, such that loggers need not be thread-safe.
+
+    Args:
+        pages (list(int)): page numbers to process, in the output's order
+        download (callable): page -> downloaded item
+        convert (callable): list(tuple(page, downloaded item)) ->
+            list(tuple(page, converted item or exception))
+        merge (callable): (page, converted item) -> None
+        skip (callable): (page, stage name, exception) -> None
+        download_concurrency (int): number of parallel downloads
+        convert_workers (int): number of conversion workers
+        convert_batch_size (int): maximum number of pages per 'convert' call
+        max_in_flight (int): maximum number of pages between download and
+            merge
+
+    Returns:
+        None
+    """
+    in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+    abort = threading.Event()
+    convert_queue = queue.Queue()
+    results = queue.Queue()
+
+    def download_page(page):
+        try:
+            convert_queue.put((page, download(page)))
+        except Exception as e:
+            results.put((page, "download", e))
+
+    def feed():
+        with ThreadPoolExecutor(max_workers=max(1, download_concurrency)) as executor:
+            for page in pages:
+                in_flight.acquire()
+                if abort.is_set():
+                    break
+                executor.submit(download_page, page)
+        for _ in range(convert_workers):
+            convert_queue.put(_DONE)
+
+    def convert_pages():
+        done = False
+        while not done:
+            item = convert_queue.get()
+            if item is _DONE:
+                break
+            batch = [item]
+            while len(batch) < convert_batch_size:
+                try:
+                    item = convert_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+            try:
+                for page, result in convert(batch):
+                    results.put((page, "convert", result) if isinstance(result, Exception) else (page, None, result))
+            except Exception as e:
+                for page, _ in batch:
+                    results.put((page, "convert", e))
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    workers = [threading.Thread(target=convert_pages, daemon=True) for _ in range(max(1, convert_workers))]
+    convert_workers = len(workers)
+    feeder.start()
+    for worker in workers:
+        worker.start()
+
+    pending = {}
+    next_index = 0
+    try:
+        while next_index < len(pages):
+            page, stage, result = results.get()
+            pending[page] = (stage, result)
+            while next_index < len(pages) and pages[next_index] in pending:
+                stage, result = pending.pop(pages[next_index])
+                if stage is None:
+                    merge(pages[next_index], result)
+                else:
+                    skip(pages[next_index], stage, result)
+                in_flight.release()
+                next_index += 1
+    finally:
+        # Unblock the feeder if the merge failed, such that all threads exit.
+        abort.set()
+        for _ in range(max(1, max_in_flight)):
+            try:
+                in_flight.release()
+            except ValueError:
+                break
+        feeder.join()
+        for worker in workers:
+            worker.join()
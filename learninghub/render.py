@@ -0,0 +1,265 @@
+import os
+import subprocess
+import logging
+import functools
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+RENDERERS = ("inkscape", "cairo")
+
+
+class RenderError():
+    """Describes why a single page could not be rendered. Carries the output
+    of the inkscape process responsible for the page, or the traceback of the
+    in-process renderer."""
+    def __init__(self, stdout, stderr):
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __str__(self):
+        return f"stdout: {self.stdout}\nstderr: {self.stderr}"
+
+
+def render_page(svg_path, pdf_path, env=None):
+    """Renders a single SVG file to PDF using a dedicated inkscape process.
+    'env' is the environment inkscape is run with.
+
+    Returns:
+        RenderError: 'None' if the page was rendered successfully.
+    """
+    result = subprocess.run(["inkscape", f"--export-filename={pdf_path}", svg_path], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return RenderError(str(result.stdout, 'utf-8'), str(result.stderr, 'utf-8'))
+    return None
+
+
+# Characters which separate the shell's actions and their arguments.
+_SHELL_SEPARATORS = (";", ":", "\n")
+
+
+def render_batch(pages, env=None):
+    """Renders many SVG files to PDF using a single long-lived inkscape
+    process driven via 'inkscape --shell', such that inkscape's startup cost
+    is paid only once per batch.
+
+    The shell does not report per-page failures reliably, hence existing
+    PDFs are removed first, and a page is considered failed if its PDF was
+    not written once inkscape exited. If the shell dies, the pages it left
+    out are rendered one per process (see 'render_page'), as are pages whose
+    paths cannot be passed to the shell.
+
+    Args:
+        pages (list(tuple(str, str))): pairs of input SVG and output PDF paths
+        env (dict): environment to run inkscape with
+
+    Returns:
+        dict: maps the input paths of pages which failed to a RenderError
+    """
+    single = [(svg_path, pdf_path) for svg_path, pdf_path in pages
+              if any(c in svg_path + pdf_path for c in _SHELL_SEPARATORS)]
+    pages = [page for page in pages if page not in single]
+    errors = {}
+    if pages:
+        for _, pdf_path in pages:
+            try:
+                os.remove(pdf_path)  # left by an earlier attempt
+            except FileNotFoundError:
+                pass
+        commands = "".join(
+            f"file-open:{svg_path}; export-filename:{pdf_path}; export-do; file-close\n"
+            for svg_path, pdf_path in pages
+        )
+        commands += "quit\n"
+        result = subprocess.run(["inkscape", "--shell"], input=commands.encode(), env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        missing = [(svg_path, pdf_path) for svg_path, pdf_path in pages if not os.path.isfile(pdf_path)]
+        if result.returncode != 0:
+            single += missing
+        else:
+            error = RenderError(str(result.stdout, 'utf-8'), str(result.stderr, 'utf-8'))
+            errors = {svg_path: error for svg_path, _ in missing}
+    for svg_path, pdf_path in single:
+        error = render_page(svg_path, pdf_path, env=env)
+        if error is not None:
+            errors[svg_path] = error
+    return errors
+
+
+@functools.lru_cache(maxsize=None)
+def inkscape_version():
+    """Returns inkscape's version string, or 'unknown' if inkscape does not
+    report it."""
+    try:
+        result = subprocess.run(["inkscape", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return "unknown"
+    lines = str(result.stdout, "utf-8", "replace").strip().splitlines()
+    return lines[0] if result.returncode == 0 and lines else "unknown"
+
+
+class InkscapeRenderer():
+    """Renders pages using inkscape processes, one per page or, for several
+    pages, one 'inkscape --shell' per call (see 'render_page' and
+    'render_batch').
+
+    A renderer's 'tag' identifies the renderer and its version, such that
+    PDFs cached by their SVG are not reused by a different renderer."""
+    name = "inkscape"
+
+    def __init__(self, env=None):
+        self.env = env
+        self.tag = f"inkscape {inkscape_version()}"
+
+    def render(self, pages):
+        """Renders pages to PDF.
+
+        Args:
+            pages (list(tuple(str, str))): pairs of input SVG and output PDF
+                paths
+
+        Returns:
+            dict: maps the input paths of pages which failed to a RenderError
+        """
+        if len(pages) == 1:
+            svg_path, pdf_path = pages[0]
+            error = render_page(svg_path, pdf_path, env=self.env)
+            return {svg_path: error} if error else {}
+        return render_batch(pages, env=self.env)
+
+    def close(self):
+        pass
+
+
+def _init_cairo_worker(fontconfig_file):
+    # Must be set before cairo initializes fontconfig, i.e. before the first
+    # page is rendered, such that the worker sees the job's fonts only.
+    if fontconfig_file is not None:
+        os.environ["FONTCONFIG_FILE"] = fontconfig_file
+
+
+def _render_cairo(svg_path, pdf_path):
+    import cairosvg
+    try:
+        cairosvg.svg2pdf(url=svg_path, write_to=pdf_path)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def cairo_available():
+    """Returns whether the optional cairosvg package and the cairo library
+    can be loaded."""
+    try:
+        import cairosvg  # noqa: F401
+    except (ImportError, OSError):  # OSError if the cairo library is missing
+        return False
+    return True
+
+
+class CairoRenderer():
+    """Renders pages using cairosvg in a pool of long-lived worker processes,
+    such that no process is started per page.
+
+    The workers are separate processes, as fontconfig is configured per
+    process and each job brings its own fonts (see 'install_fonts'). Pages
+    which cairosvg fails to render are passed to 'fallback', which is part
+    of the renderer's 'tag'.
+    """
+    name = "cairo"
+
+    def __init__(self, env=None, workers=None, fallback=None):
+        """
+        Args:
+            env (dict): environment whose 'FONTCONFIG_FILE' the workers use
+            workers (int): number of worker processes. Defaults to the number
+                of CPUs.
+            fallback (InkscapeRenderer): renderer for the pages which failed
+        """
+        import cairosvg
+        self.fallback = fallback
+        self.tag = f"cairo {cairosvg.__version__}" + (f" + {fallback.tag}" if fallback is not None else "")
+        self._executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_cairo_worker,
+                                             initargs=((env or {}).get("FONTCONFIG_FILE"),))
+
+    def render(self, pages):
+        """See 'InkscapeRenderer.render'."""
+        futures = [(svg_path, self._executor.submit(_render_cairo, svg_path, pdf_path)) for svg_path, pdf_path in pages]
+        errors = {}
+        for svg_path, future in futures:
+            try:
+                message = future.result()
+            except Exception as e:  # e.g. a worker was killed
+                message = repr(e)
+            if message is not None:
+                errors[svg_path] = RenderError("", message)
+        if errors and self.fallback is not None:
+            logger.debug(f"Render {len(errors)} pages using {self.fallback.name} instead.")
+            errors = self.fallback.render([(svg_path, pdf_path) for svg_path, pdf_path in pages if svg_path in errors])
+        return errors
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def make_renderer(name="inkscape", env=None, workers=None):
+    """Returns a renderer by name. 'cairo' falls back to inkscape, entirely if
+    cairosvg is not installed, and for the pages cairosvg fails to render.
+
+    Args:
+        name (str): one of 'RENDERERS'
+        env (dict): environment as returned by 'install_fonts'
+        workers (int): number of pages rendered in parallel
+
+    Returns:
+        InkscapeRenderer or CairoRenderer: must be closed after use
+    """
+    if name not in RENDERERS:
+        raise ValueError(f"Unknown renderer '{name}', expected one of {RENDERERS}.")
+    if name == "cairo":
+        if cairo_available():
+            return CairoRenderer(env, workers, fallback=InkscapeRenderer(env))
+        logger.warning("The cairo renderer requires cairosvg and the cairo library. Use inkscape instead.")
+    return InkscapeRenderer(env)
+
+
+def render_pages(pages, workers=None, batch_size=None, env=None, renderer="inkscape"):
+    """Renders SVG files to PDF, spreading the pages over a pool of inkscape
+    processes, or over the worker processes of another renderer.
+
+    Results are yielded in order of completion and are consumed by the calling
+    thread, such that loggers need not be thread-safe.
+
+    Args:
+        pages (list(tuple(str, str))): pairs of input SVG and output PDF paths
+        workers (int): number of inkscape processes running in parallel.
+            Defaults to the number of CPUs.
+        batch_size (int): number of pages rendered by a single inkscape shell.
+            If 'None' is passed, one inkscape process is started per page.
+        env (dict): environment to run inkscape with
+        renderer (str): one of 'RENDERERS' (see 'make_renderer')
+
+    Yields:
+        tuple(str, str, RenderError): input path, output path and the error
+            which occurred, if any.
+    """
+    workers = workers or os.cpu_count() or 1
+    backend = make_renderer(renderer, env=env, workers=workers)
+    batch_size = batch_size or 1
+    batches = [pages[ii:ii+batch_size] for ii in range(0, len(pages), batch_size)]
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(backend.render, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                errors = future.result()
+                for svg_path, pdf_path in futures[future]:
+                    yield svg_path, pdf_path, errors.get(svg_path)
+    finally:
+        backend.close()
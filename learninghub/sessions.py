@@ -0,0 +1,123 @@
+import os
+import hmac
+import time
+import hashlib
+import logging
+import threading
+
+from learninghub.fetch import FetchController
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class SessionCache():
+    """In-memory cache of the cookies exported after a successful browser
+    login, such that repeated conversions by the same user can skip the
+    browser.
+
+    Entries are keyed by username and only returned if the password matches
+    the one used for the login, which is stored as a salted PBKDF2 hash. Entries
+    expire after 'ttl' seconds. Instances may be shared between threads.
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._entries = {}  # username -> (salt, password hash, expiry, cookies)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(password, salt):
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100000)
+
+    def get(self, username, password):
+        """Returns the cookies cached for the user, or 'None' if there are
+        none, they expired or the password does not match."""
+        with self._lock:
+            entry = self._entries.get(username)
+        if entry is None:
+            return None
+        salt, password_hash, expiry, cookies = entry
+        if time.time() > expiry:
+            self.invalidate(username)
+            return None
+        if not hmac.compare_digest(password_hash, self._hash(password, salt)):
+            return None
+        return dict(cookies)
+
+    def put(self, username, password, cookies):
+        salt = os.urandom(16)
+        entry = (salt, self._hash(password, salt), time.time() + self.ttl, dict(cookies))
+        with self._lock:
+            self._entries[username] = entry
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+
+class ProbeError(Exception):
+    """Raised if a page's existence cannot be determined, e.g. since the
+    server kept failing transiently or redirected to the login."""
+
+
+def page_exists(fetcher, indexhtml, page, timeout=30):
+    """Returns whether an ebook's page exists. Only the reply's headers are
+    transferred, and transient failures are retried by 'fetcher'.
+
+    Only an HTTP 404 means that the page does not exist. Redirects are not
+    followed, since with expired cookies every url redirects to the login
+    page.
+
+    Raises:
+        ProbeError: if the reply is neither an SVG nor an HTTP 404
+    """
+    import requests
+    baseurl = indexhtml[:-11]
+    try:
+        with fetcher.get(f"{baseurl}/xml/topic{page}.svg", stream=True, allow_redirects=False, timeout=timeout) as reply:
+            if reply.status_code == 404:
+                return False
+            if reply.status_code == 200 and "svg" in reply.headers.get("Content-Type", ""):
+                return True
+            raise ProbeError(f"Probing page {page} returned HTTP {reply.status_code}.")
+    except requests.RequestException as e:
+        raise ProbeError(f"Probing page {page} failed: {e}") from e
+
+
+def probe_num_pages(session, indexhtml, max_pages=10_000, timeout=30):
+    """Determines an ebook's number of pages without a browser by probing for
+    the existence of its pages. Uses an exponential search followed by a
+    binary search, i.e. about 2*log2(n) requests for n pages.
+
+    Since a single misjudged probe would shorten the ebook, the probe gives
+    up if any page's existence cannot be determined (see 'page_exists'), and
+    the caller falls back to the browser.
+
+    Args:
+        max_pages (int): upper bound of the exponential search. Beyond it,
+            the probe gives up.
+        timeout (float): seconds to wait for each reply
+
+    Returns:
+        int: the number of pages, or 0 if the probe gave up or the first page
+            does not exist
+    """
+    fetcher = FetchController(session)
+    try:
+        if not page_exists(fetcher, indexhtml, 1, timeout):
+            return 0
+        lo, hi = 1, 2  # invariant: page 'lo' exists
+        while page_exists(fetcher, indexhtml, hi, timeout):
+            if hi > max_pages:
+                return 0
+            lo, hi = hi, hi * 2
+        while hi - lo > 1:  # invariant: page 'hi' does not exist
+            mid = (lo + hi) // 2
+            if page_exists(fetcher, indexhtml, mid, timeout):
+                lo = mid
+            else:
+                hi = mid
+    except ProbeError as e:
+        logger.warning(f"{e} Give up probing the number of pages.")
+        return 0
+    return lo
@@ -0,0 +1,257 @@
+import os
+import re
+import base64
+import hashlib
+import logging
+import tempfile
+import xml.sax
+from pathlib import Path
+from xml.sax.saxutils import XMLGenerator
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Attributes holding coordinates or lengths in user units, whose numbers are
+# rounded. Transforms are left alone, as their scale factors may be small.
+GEOMETRY_ATTRIBUTES = {
+    "d", "points", "x", "y", "x1", "y1", "x2", "y2", "cx", "cy", "r", "rx", "ry",
+    "fx", "fy", "width", "height", "dx", "dy", "viewBox", "stroke-width", "font-size",
+}
+HREF_ATTRIBUTES = ("href", "xlink:href")
+MIN_EXTRACTED_IMAGE_BYTES = 1024  # smaller embedded images are left inline
+
+_reference = re.compile(r"url\(\s*['\"]?#([^'\")\s]+)")
+_data_uri = re.compile(r"data:image/(png|jpeg|jpg|gif|webp);base64,", re.IGNORECASE)
+_number = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_flag = re.compile(r"[01]")  # of arcs, which path data may write without separators
+
+
+class _ReferenceCollector(xml.sax.ContentHandler):
+    """First pass: collects the ids referenced anywhere in the document, and
+    the ids defined within each direct child of a '<defs>'."""
+    def __init__(self):
+        super().__init__()
+        self.referenced = set()
+        self.definitions = []  # per direct child of a <defs>: (its id, ids within its subtree)
+        self._in_style = False
+        self._depth = 0
+        self._defs_depth = None
+
+    def unused_definitions(self):
+        """Returns the indices (in document order) of the direct children of
+        '<defs>' which have an id, but define no referenced id."""
+        return {ii for ii, (element_id, ids) in enumerate(self.definitions)
+                if element_id is not None and not ids & self.referenced}
+
+    def startElement(self, name, attrs):
+        self._depth += 1
+        self._in_style = name == "style"
+        if self._defs_depth is not None and self._depth == self._defs_depth + 1:
+            self.definitions.append((attrs.get("id"), set()))
+        if self._defs_depth is not None and self._depth > self._defs_depth and "id" in attrs:
+            self.definitions[-1][1].add(attrs["id"])
+        if name == "defs" and self._defs_depth is None:
+            self._defs_depth = self._depth
+        for attr, value in attrs.items():
+            if attr in HREF_ATTRIBUTES and value.startswith("#"):
+                self.referenced.add(value[1:])
+            elif "url(" in value:
+                self.referenced.update(_reference.findall(value))
+
+    def endElement(self, name):
+        self._in_style = False
+        if self._depth == self._defs_depth:
+            self._defs_depth = None
+        self._depth -= 1
+
+    def characters(self, content):
+        if self._in_style and "url(" in content:
+            self.referenced.update(_reference.findall(content))
+
+
+class _Optimizer(xml.sax.ContentHandler):
+    """Second pass: writes the document without unused definitions, with
+    embedded images moved to 'image_dir' and with rounded coordinates."""
+    def __init__(self, out, unused, image_dir, precision, base_dir):
+        super().__init__()
+        self.out = XMLGenerator(out, encoding="utf-8", short_empty_elements=True)
+        self.unused = unused  # see '_ReferenceCollector.unused_definitions'
+        self.image_dir = image_dir
+        self.base_dir = base_dir  # directory of the output, which image paths are relative to
+        self.precision = precision
+        self.num_removed = 0
+        self.num_extracted = 0
+        self._depth = 0
+        self._defs_depth = None  # depth of the enclosing <defs>
+        self._skip_depth = None  # depth of the element being dropped
+        self._num_definitions = 0  # direct children of <defs> seen so far
+
+    def _round(self, number):
+        if "." not in number or "e" in number.lower():
+            return number
+        rounded = f"{float(number):.{self.precision}f}".rstrip("0").rstrip(".")
+        if rounded in ("-0", "", "-"):
+            return "0"
+        return re.sub(r"^(-?)0\.", r"\1.", rounded)  # '.5' as in the input, rather than '0.5'
+
+    def _round_numbers(self, value, path=False):
+        """Rounds the decimals in an attribute's value. Path data ('path') is
+        tokenized along its commands, such that arc flags are not mistaken
+        for the start of a number. A separator is inserted wherever a number
+        rounded to an integer would otherwise merge with the next one, e.g.
+        'M1.0001.5' becomes 'M1 .5' rather than 'M1.5'."""
+        out = []
+        pos = 0
+        command = None
+        index = 0  # of the argument within the current path command
+        previous = None  # number written immediately before 'pos'
+        while pos < len(value):
+            if path and value[pos].isalpha():
+                command, index = value[pos].lower(), 0
+            elif path and command == "a" and index % 7 in (3, 4):
+                match = _flag.match(value, pos)
+                if match is not None:
+                    out.append(match.group(0))
+                    pos, index, previous = match.end(), index + 1, None
+                    continue
+            else:
+                match = _number.match(value, pos)
+                if match is not None:
+                    number = self._round(match.group(0))
+                    if previous is not None and not re.search(r"[.eE]", previous) and number[0] == ".":
+                        out.append(" ")
+                    out.append(number)
+                    pos, index, previous = match.end(), index + 1, number
+                    continue
+            out.append(value[pos])
+            pos, previous = pos + 1, None
+        return "".join(out)
+
+    def _extract_image(self, value):
+        match = _data_uri.match(value)
+        if match is None or len(value) < MIN_EXTRACTED_IMAGE_BYTES or self.image_dir is None:
+            return value
+        try:
+            data = base64.b64decode(value[match.end():])
+        except ValueError:
+            return value
+        extension = match.group(1).lower().replace("jpeg", "jpg")
+        path = Path(self.image_dir) / f"{hashlib.sha256(data).hexdigest()}.{extension}"
+        if not path.exists():
+            fd, tmp_path = tempfile.mkstemp(dir=self.image_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self.num_extracted += 1
+        # Relative, such that the SVG's content (and the PDF cached by its
+        # hash) does not depend on the job's directory.
+        return Path(os.path.relpath(path, self.base_dir)).as_posix()
+
+    def startDocument(self):
+        self.out.startDocument()
+
+    def endDocument(self):
+        self.out.endDocument()
+
+    def startElement(self, name, attrs):
+        self._depth += 1
+        if self._skip_depth is not None:
+            return
+        if self._defs_depth is not None and self._depth == self._defs_depth + 1:
+            self._num_definitions += 1
+            if self._num_definitions - 1 in self.unused:
+                self._skip_depth = self._depth
+                self.num_removed += 1
+                return
+        if name == "defs" and self._defs_depth is None:
+            self._defs_depth = self._depth
+        optimized = {}
+        for attr, value in attrs.items():
+            if attr in GEOMETRY_ATTRIBUTES:
+                value = self._round_numbers(value, path=attr == "d")
+            elif attr in HREF_ATTRIBUTES and name == "image":
+                value = self._extract_image(value)
+            optimized[attr] = value
+        self.out.startElement(name, optimized)
+
+    def endElement(self, name):
+        depth = self._depth
+        self._depth -= 1
+        if self._skip_depth is not None:
+            if depth == self._skip_depth:
+                self._skip_depth = None
+            return
+        if depth == self._defs_depth:
+            self._defs_depth = None
+        self.out.endElement(name)
+
+    def characters(self, content):
+        if self._depth == self._defs_depth and content.isspace():
+            return  # whitespace between definitions is insignificant
+        if self._skip_depth is None:
+            self.out.characters(content)
+
+    def ignorableWhitespace(self, content):
+        if self._skip_depth is None:
+            self.out.ignorableWhitespace(content)
+
+    def processingInstruction(self, target, data):
+        if self._skip_depth is None:
+            self.out.processingInstruction(target, data)
+
+
+def _parser(handler):
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, False)
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setContentHandler(handler)
+    return parser
+
+
+def optimize_svg(svg_path, output_path, image_dir=None, precision=3):
+    """Shrinks an SVG file for rendering. The file is parsed incrementally,
+    twice: once to collect the referenced ids, and once to write the output.
+
+    The output
+    - lacks the direct children of '<defs>' of which neither the child
+      itself nor any element within it is referenced,
+    - refers to embedded images (of at least 'MIN_EXTRACTED_IMAGE_BYTES')
+      as files in 'image_dir', stored by their content hash, such that
+      images repeated across pages are stored and decoded once. The files
+      are referred to by paths relative to the output. They are written
+      under temporary names and renamed once complete, since pages
+      optimized concurrently may share them,
+    - has the numbers of geometry attributes rounded to 'precision' decimals,
+    - lacks comments and the doctype.
+
+    Args:
+        svg_path (str): system path of the SVG file
+        output_path (str): system path of the optimized SVG file. May equal
+            'svg_path'.
+        image_dir (str): system path of the directory for extracted images.
+            If 'None' is passed, images are left inline.
+        precision (int): decimals kept of coordinates and lengths
+
+    Returns:
+        dict: sizes of the input and output in bytes, and the numbers of
+            removed definitions and extracted images
+    """
+    collector = _ReferenceCollector()
+    _parser(collector).parse(svg_path)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), suffix=".svg.tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as out:
+            optimizer = _Optimizer(out, collector.unused_definitions(), image_dir, precision, os.path.dirname(os.path.abspath(output_path)))
+            _parser(optimizer).parse(svg_path)
+        bytes_in = os.path.getsize(svg_path)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return {
+        "bytes_in": bytes_in,
+        "bytes_out": os.path.getsize(output_path),
+        "removed_defs": optimizer.num_removed,
+        "extracted_images": optimizer.num_extracted,
+    }
@@ -1,7 +1,37 @@
+import sys
+import time
+import argparse
+import threading
+
+started = time.perf_counter()
+
 import yaml
 
-from app import app
+from app import app, routes
+
+
+def warm_up(worker=False):
+    seconds = routes.warm_up(worker=worker)
+    steps = ", ".join(f"{step} {value:.3f} s" for step, value in seconds.items())
+    print(f"Warmed up in {sum(seconds.values()):.3f} s ({steps}).", file=sys.stderr)
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--worker", action="store_true",
+                        help="run the conversions enqueued with the configured broker instead of serving the web interface")
+    args = parser.parse_args()
+
+    imported = time.perf_counter() - started
     app.config = app.config | yaml.safe_load(open("./config.yml"))
-    app.run("0.0.0.0", app.config["port"])
+    if app.config.get("warm_up", True):
+        threading.Thread(target=warm_up, args=(args.worker,), daemon=True).start()
+    ready = time.perf_counter() - started
+    routes.REGISTRY.observe("learninghub_startup_seconds", ready, step="ready")
+    print(f"Ready {'to take jobs' if args.worker else 'to serve'} after {ready:.3f} s ({imported:.3f} s importing the app). "
+          "Run 'python -m bench.startup' for a breakdown of the imports.", file=sys.stderr)
+    if args.worker:
+        print(f"Take jobs from '{app.config.get('broker')}'.", file=sys.stderr)
+        routes.run_worker()
+    else:
+        app.run("0.0.0.0", app.config["port"])